@@ -28,6 +28,8 @@ echo "Sync files..."
 rsync -av --delete \
   --exclude '.git' \
   --exclude '__pycache__' \
+  --exclude 'logs/' \
+  --exclude 'macros.json' \
   "$SRC_DIR/" "$APP_DIR/"
 
 if [ -f "$APP_DIR/requirements.txt" ]; then
@@ -1,57 +1,403 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import bisect
+import collections
 import socket
+import stat
 import threading
 import subprocess
 import os
-import queue
-from flask import Flask, render_template_string, request, redirect, url_for, Response, jsonify
+import sys
+import time
+import urllib.parse
+from concurrent.futures import Future, wait as wait_futures
+import gzip
+import hashlib
+import heapq
+import math
+from flask import Flask, request, redirect, url_for, Response, jsonify
 from gpiozero import Motor, DistanceSensor
 import json
+import struct
+
+try:
+    import brotli # Optional, assets are also served gzip-compressed without it
+except ImportError:
+    brotli = None
 
 # --- Global Logging ---
+LOG_CAPACITY = 1024 # Ring slots; a listener lagging further behind loses the oldest lines
+LOG_HISTORY = 50 # Lines replayed to a new listener
+LOG_BATCH = 200 # Max lines handed to a listener per read
+
+class LogListener:
+    __slots__ = ("cursor", "dropped")
+
+    def __init__(self, cursor):
+        self.cursor = cursor # Sequence number of the next line to read
+        self.dropped = 0
+
 class LogManager:
-    def __init__(self):
-        self.listeners = []
-        self.history = []
+    """Fixed-capacity ring buffer of log lines with sequence numbers.
+
+    broadcast() writes one slot and bumps the sequence under a short lock;
+    it never touches listeners. Each listener keeps its own cursor and reads
+    batches with read(). A listener that falls more than capacity lines
+    behind skips the overwritten lines and has them added to its drop count.
+    """
+
+    def __init__(self, capacity=LOG_CAPACITY, history=LOG_HISTORY, start_seq=0):
+        self.capacity = capacity
+        self.history = min(history, capacity)
+        self.slots = [None] * capacity # (timestamp, message)
+        self.start_seq = start_seq # Continues the on-disk sequence across restarts
+        self.seq = start_seq # Sequence number of the next line
+        self.cond = threading.Condition()
+        self.listeners = set()
+
+    def add_listener(self, replay=None):
+        # New listeners start `replay` lines back; nothing is copied here
+        replay = self.history if replay is None else min(replay, self.capacity)
+        with self.cond:
+            listener = LogListener(max(self.start_seq, self.seq - replay))
+            self.listeners.add(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        with self.cond:
+            self.listeners.discard(listener)
+
+    def seek(self, listener, seq):
+        # Move a listener to an absolute sequence number (SSE resume)
+        with self.cond:
+            listener.cursor = max(self.start_seq, min(seq, self.seq))
+
+    def oldest(self):
+        return max(self.start_seq, self.seq - self.capacity)
+
+    def broadcast(self, msg):
+        entry = (time.time(), msg)
+        with self.cond:
+            self.slots[self.seq % self.capacity] = entry
+            self.seq += 1
+            self.cond.notify_all()
+
+    def read(self, listener, timeout=None, max_batch=LOG_BATCH):
+        """Return (first_seq, [(timestamp, message), ...]) for the listener, waiting up to timeout if none."""
+        with self.cond:
+            if listener.cursor >= self.seq and timeout:
+                self.cond.wait(timeout)
+            oldest = max(self.start_seq, self.seq - self.capacity)
+            if listener.cursor < oldest:
+                listener.dropped += oldest - listener.cursor
+                listener.cursor = oldest
+            start = listener.cursor
+            end = min(self.seq, start + max_batch)
+            lines = [self.slots[i % self.capacity] for i in range(start, end)]
+            listener.cursor = end
+        return start, lines
+
+    def stats(self):
+        with self.cond:
+            return {"seq": self.seq, "capacity": self.capacity,
+                    "listeners": [{"lag": self.seq - l.cursor, "dropped": l.dropped} for l in self.listeners]}
+
+    def start_console(self):
+        # Console output is drained in batches on its own thread so broadcasters never block on stdout
+        def drain():
+            listener = self.add_listener(replay=0)
+            while True:
+                _, entries = self.read(listener, timeout=1.0)
+                if entries:
+                    sys.stdout.write("\n".join(msg for _, msg in entries) + "\n")
+                    sys.stdout.flush()
+        threading.Thread(target=drain, name="log-console", daemon=True).start()
+
+# --- Persistent Log Store ---
+LOG_DIR = "logs"
+LOG_SEGMENT_BYTES = 1024 * 1024 # Rotate the active segment at this size
+LOG_MAX_SEGMENTS = 8 # Oldest segments beyond this are deleted
+LOG_INDEX_EVERY = 64 # One sparse index entry per this many records
+LOG_FLUSH_INTERVAL = 1.0 # Seconds between buffer flushes (no fsync)
+LOG_PAGE_MAX = 1000
+
+class LogSegment:
+    __slots__ = ("first_seq", "path", "index")
+
+    def __init__(self, first_seq, path):
+        self.first_seq = first_seq
+        self.path = path
+        self.index = [] # Sparse [(seq, timestamp, byte offset)], ascending
+
+class LogStore:
+    """Append-only, size-capped on-disk log with a sparse seq/time index.
+
+    Records are "<seq>\\t<timestamp>\\t<message>" lines in segment files
+    named after their first sequence number. Writes are block-buffered and
+    flushed about once a second without fsync. Every LOG_INDEX_EVERY-th
+    record gets an index entry (kept in memory and in a .idx file), so a page
+    query seeks close to its start and reads forward instead of scanning.
+    """
+
+    def __init__(self, directory=LOG_DIR):
+        self.directory = directory
         self.lock = threading.Lock()
+        self.segments = []
+        self.file = None
+        self.index_file = None
+        self.size = 0
+        self.next_seq = 0
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._load()
+        except OSError as e:
+            print(f"Log store disabled: {e}")
+            self.directory = None
+
+    def _load(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith("log-") and name.endswith(".log"):
+                first = int(name[4:-4])
+                self.segments.append(LogSegment(first, os.path.join(self.directory, name)))
+        self.segments.sort(key=lambda seg: seg.first_seq)
+        for seg in self.segments:
+            self._load_index(seg)
+        if self.segments:
+            seg = self.segments[-1]
+            last = self._recover_tail(seg)
+            self.next_seq = seg.first_seq if last is None else last + 1
+
+    def _load_index(self, seg):
+        try:
+            with open(seg.path[:-4] + ".idx") as f:
+                for line in f:
+                    seq, ts, offset = line.split()
+                    seg.index.append((int(seq), float(ts), int(offset)))
+        except (OSError, ValueError):
+            seg.index = [] # Queries fall back to reading this segment from the start
+
+    def _recover_tail(self, seg):
+        # Drop a torn last line left by a crash and return the last complete sequence number
+        with open(seg.path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            f.seek(max(0, end - 65536))
+            tail = f.read()
+            cut = tail.rfind(b"\n")
+            if cut < 0:
+                f.truncate(0)
+                return None
+            if cut != len(tail) - 1:
+                f.truncate(end - len(tail) + cut + 1)
+            start = tail.rfind(b"\n", 0, cut) + 1
+            try:
+                return int(tail[start:cut].split(b"\t", 1)[0])
+            except ValueError:
+                return None
+
+    def _open_segment(self, seg):
+        if not self.segments or self.segments[-1] is not seg:
+            self.segments.append(seg)
+        self.file = open(seg.path, "ab", buffering=64 * 1024)
+        self.index_file = open(seg.path[:-4] + ".idx", "a", buffering=8 * 1024)
+        self.size = self.file.tell()
+        while len(self.segments) > LOG_MAX_SEGMENTS:
+            old = self.segments.pop(0)
+            for path in (old.path, old.path[:-4] + ".idx"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def append(self, seq, ts, msg):
+        if self.directory is None:
+            return
+        with self.lock:
+            if self.file is None and self.segments and os.path.getsize(self.segments[-1].path) < LOG_SEGMENT_BYTES:
+                self._open_segment(self.segments[-1]) # Keep appending to the last segment after a restart
+            elif self.file is None or self.size >= LOG_SEGMENT_BYTES:
+                if self.file:
+                    self.file.close()
+                    self.index_file.close()
+                self._open_segment(LogSegment(seq, os.path.join(self.directory, f"log-{seq:012d}.log")))
+            seg = self.segments[-1]
+            if (seq - seg.first_seq) % LOG_INDEX_EVERY == 0 or not seg.index:
+                seg.index.append((seq, ts, self.size))
+                self.index_file.write(f"{seq} {ts!r} {self.size}\n")
+            # Full precision: /logs?from= takes timestamps straight from the live stream
+            data = f"{seq}\t{ts!r}\t{msg}".replace("\n", "\\n").encode("utf-8", "replace") + b"\n"
+            self.file.write(data)
+            self.size += len(data)
+            self.next_seq = seq + 1
 
-    def add_listener(self):
-        q = queue.Queue(maxsize=500)
+    def flush(self):
         with self.lock:
-            # Play back history to new listener
-            print(f"New log listener added. Playing back {len(self.history)} history lines.")
-            for msg in self.history:
-                try: q.put(msg, block=False)
-                except: pass
-            self.listeners.append(q)
-        return q
-
-    def remove_listener(self, q):
+            if self.file:
+                self.file.flush()
+                self.index_file.flush()
+
+    def query(self, since=None, ts_from=None, ts_to=None, limit=100):
+        """Return up to limit records with seq > since, or with ts_from <= timestamp <= ts_to."""
+        if self.directory is None:
+            return []
+        limit = max(1, min(limit, LOG_PAGE_MAX))
         with self.lock:
-            if q in self.listeners:
-                self.listeners.remove(q)
+            if self.file:
+                self.file.flush()
+            segments = list(self.segments)
+        if since is not None:
+            pos = bisect.bisect_right([seg.first_seq for seg in segments], since + 1) - 1
+            key = lambda entry: entry[0] <= since + 1
+        else:
+            ts_from = ts_from or 0.0
+            pos = 0
+            for i, seg in enumerate(segments):
+                if seg.index and seg.index[0][1] <= ts_from:
+                    pos = i
+            key = lambda entry: entry[1] <= ts_from
+        records = []
+        for seg in segments[max(0, pos):]:
+            offset = 0
+            for entry in seg.index:
+                if not key(entry):
+                    break
+                offset = entry[2]
+            try:
+                with open(seg.path, "rb") as f:
+                    f.seek(offset)
+                    for raw in f:
+                        rec = self._parse(raw)
+                        if rec is None:
+                            continue
+                        if since is not None and rec["seq"] <= since:
+                            continue
+                        if ts_from and rec["ts"] < ts_from:
+                            continue
+                        if ts_to is not None and rec["ts"] > ts_to:
+                            return records
+                        records.append(rec)
+                        if len(records) >= limit:
+                            return records
+            except OSError:
+                continue
+        return records
 
-    def broadcast(self, msg):
-        msg_line = f"{msg}" # Raw text without newline
-        print(msg) # Still print to console
+    @staticmethod
+    def _parse(raw):
+        try:
+            seq, ts, msg = raw.decode("utf-8", "replace").rstrip("\n").split("\t", 2)
+            return {"seq": int(seq), "ts": float(ts), "msg": msg.replace("\\n", "\n")}
+        except ValueError:
+            return None
+
+    def attach(self, manager):
+        # Persist everything broadcast from now on, reading the ring in batches
+        def writer():
+            listener = manager.add_listener(replay=0)
+            last_flush = time.monotonic()
+            while True:
+                first, entries = manager.read(listener, timeout=LOG_FLUSH_INTERVAL)
+                for offset, (ts, msg) in enumerate(entries):
+                    try:
+                        self.append(first + offset, ts, msg)
+                    except OSError as e:
+                        print(f"Log store write failed: {e}")
+                if time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL:
+                    self.flush()
+                    last_flush = time.monotonic()
+        threading.Thread(target=writer, name="log-store", daemon=True).start()
+
+log_store = LogStore()
+log_manager = LogManager(start_seq=log_store.next_seq)
+log_manager.start_console()
+log_store.attach(log_manager)
+
+# --- Log Levels & Aggregation ---
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+LOG_CATEGORIES = ("system", "bt", "net", "control", "config", "wifi", "jobs")
+log_levels = dict.fromkeys(LOG_CATEGORIES, INFO) # Changed at runtime via LOG_LEVEL / POST /log_levels
+AGGREGATED_CATEGORIES = {"control"} # Repeats collapse into one line unless the category is at DEBUG
+LOG_AGGREGATE_WINDOW = 1.0 # Seconds
+
+class LogAggregator:
+    """Collapses repeats of the same message within a time window.
+
+    The first occurrence of a key is logged at once; further ones inside the
+    window are only counted and reported as a single summary line when the
+    window closes, e.g. "Movement CMD: FORWARD x37 in 1.0s".
+    """
+
+    def __init__(self, window=LOG_AGGREGATE_WINDOW):
+        self.window = window
+        self.pending = {} # key -> [count, first monotonic time, last message]
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        threading.Thread(target=self._run, name="log-aggregator", daemon=True).start()
+
+    def add(self, key, msg):
+        """Count a message; returns True if the caller should log it now."""
         with self.lock:
-            self.history.append(msg_line)
-            if len(self.history) > 50:
-                self.history.pop(0)
-            for q in self.listeners:
-                try:
-                    q.put(msg_line, block=False)
-                except queue.Full:
-                    try: 
-                        q.get_nowait()
-                        q.put(msg_line)
-                    except: pass
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [1, time.monotonic(), msg]
+                self.wake.set()
+                return True
+            entry[0] += 1
+            entry[2] = msg
+            return False
 
-log_manager = LogManager()
-is_updating = False
+    def flush(self, force=False):
+        now = time.monotonic()
+        with self.lock:
+            expired = [(k, e) for k, e in self.pending.items() if force or now - e[1] >= self.window]
+            for k, _ in expired:
+                del self.pending[k]
+            if not self.pending:
+                self.wake.clear()
+        for _, (count, first, last) in expired:
+            if count > 1:
+                log_manager.broadcast(f"{last} x{count} in {now - first:.1f}s")
+
+    def _run(self):
+        # Idle while nothing is pending
+        while True:
+            self.wake.wait()
+            time.sleep(self.window / 4)
+            self.flush()
 
-def log_msg(msg):
+log_aggregator = LogAggregator()
+
+def log_msg(msg, category="system", level=INFO, key=None):
+    threshold = log_levels.get(category, INFO)
+    if level < threshold:
+        return
+    if category in AGGREGATED_CATEGORIES and threshold > DEBUG:
+        if not log_aggregator.add((category, key or msg), msg):
+            return
     log_manager.broadcast(msg)
 
+def set_log_levels(levels):
+    """Apply {category: level name}; raises ValueError on unknown names."""
+    updates = {}
+    for category, name in levels.items():
+        if category not in log_levels:
+            raise ValueError(f"unknown log category {category!r}")
+        level = LEVEL_NAMES.get(str(name).upper())
+        if level is None:
+            raise ValueError(f"unknown log level {name!r}")
+        updates[category] = level
+    log_levels.update(updates)
+    if updates:
+        # Switching to DEBUG stops aggregation, report what was still being counted
+        log_aggregator.flush(force=True)
+
+def log_level_names():
+    names = {level: name for name, level in LEVEL_NAMES.items()}
+    return {category: names[level] for category, level in log_levels.items()}
+
 # --- Catalog & Configuration ---
 CATALOG = {
     "motor": {"default_name": "Motor", "pins": ["forward", "backward", "enable"]},
@@ -74,7 +420,7 @@ def load_config():
                 config = json.load(f)
                 # Migration: old format had "motors" and "sensor"
                 if "devices" not in config:
-                    log_msg("Migrating legacy config...")
+                    log_msg("Migrating legacy config...", "config")
                     new_devices = []
                     if "motors" in config:
                         m = config["motors"]
@@ -86,7 +432,7 @@ def load_config():
                     save_config(config)
                 return config
         except Exception as e:
-            log_msg(f"Error loading config: {e}")
+            log_msg(f"Error loading config: {e}", "config", ERROR)
     return DEFAULT_CONFIG
 
 def save_config(config):
@@ -94,48 +440,259 @@ def save_config(config):
         with open(CONFIG_FILE, "w") as f:
             json.dump(config, f, indent=4)
     except Exception as e:
-        log_msg(f"Error saving config: {e}")
+        log_msg(f"Error saving config: {e}", "config", ERROR)
+
+# --- Shared State ---
+class StateStore:
+    """Runtime state shared by the transports, the control loop and the dashboard.
+
+    Each update() that changes a value bumps the store version once and
+    stamps the changed fields with it, so delta(since) returns only what a
+    client has not seen yet. Values are replaced, never mutated in place.
+    Watchers are called after every change, outside the lock, from the
+    updating thread.
+    """
+
+    def __init__(self, **initial):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.version = 1 # 0 is reserved for "nothing seen yet"
+        self.values = dict(initial)
+        self.stamps = dict.fromkeys(initial, 1)
+        self.watchers = []
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def update(self, **fields):
+        with self.changed:
+            changed = [key for key, value in fields.items() if key not in self.values or self.values[key] != value]
+            if not changed:
+                return self.version
+            self.version += 1
+            for key in changed:
+                self.values[key] = fields[key]
+                self.stamps[key] = self.version
+            version = self.version
+            self.changed.notify_all()
+        for watcher in self.watchers:
+            watcher()
+        return version
+
+    def delta(self, since=0):
+        """Fields changed after version since; a since the store never had (restart) gets everything."""
+        with self.lock:
+            full = since <= 0 or since > self.version
+            if full:
+                since = 0
+            changes = {key: self.values[key] for key, stamp in self.stamps.items() if stamp > since or full}
+            return {"version": self.version, "full": full, "changes": changes}
+
+    def wait(self, since, timeout=None):
+        with self.changed:
+            if self.version == since:
+                self.changed.wait(timeout)
+            return self.version
+
+    def watch(self, callback):
+        self.watchers.append(callback)
+
+state = StateStore(
+    config=load_config(),
+    speed=0.5, # 0.0-1.0
+    bt_status="Disconnected",
+    bt_client=None,
+    bt_device=None,
+    bt_clients=0,
+    links={}, # Heartbeat link quality per connection, see LinkMonitor
+    macro=None, # Last macro run: {"name", "state", "reason"}
+)
 
 # --- Peripheral Registry ---
-current_config = load_config()
-peripherals = {} # Map ID or Role to gpiozero object
-
-def init_peripherals():
-    global peripherals, current_config
-    
-    # Clean up
-    for p in peripherals.values():
-        try: p.close()
+MOTOR_ROLES = {1: "move_left", 2: "move_right"} # Legacy motor ids used by the M1_/M2_ verbs
+
+MOTOR_ACCEL = 4.0 # Default output change per second when speeding up, "accel" of a motor device (0 = no limit)
+MOTOR_DECEL = 8.0 # Same when slowing down or reversing, "decel"
+MOTOR_JERK = 0.0 # Change of that rate per second for S-curve ramps, "jerk" (0 = plain linear ramps)
+
+class MotionProfile:
+    """Acceleration limits of one motor, output units (full scale = 1.0) per second.
+
+    step() moves the output one control tick toward its target: at most
+    accel per second away from zero, decel per second toward it (a reversal
+    brakes with decel down to zero, then speeds up with accel). With jerk set
+    the rate itself changes by at most jerk per second and tapers off near
+    the target, which rounds the corners of the ramp into an S-curve.
+    """
+    __slots__ = ("accel", "decel", "jerk")
+
+    def __init__(self, accel=MOTOR_ACCEL, decel=MOTOR_DECEL, jerk=MOTOR_JERK):
+        self.accel = accel
+        self.decel = decel
+        self.jerk = jerk
+
+    @classmethod
+    def from_device(cls, dev):
+        try:
+            return cls(*(max(0.0, float(dev.get(key, default)))
+                         for key, default in (("accel", MOTOR_ACCEL), ("decel", MOTOR_DECEL), ("jerk", MOTOR_JERK))))
+        except (TypeError, ValueError) as e:
+            log_msg(f"Invalid ramp settings for {dev.get('id')}, using defaults: {e}", "config", WARNING)
+            return cls()
+
+    def step(self, level, rate, target, dt):
+        # Returns the new (level, rate)
+        error = target - level
+        if abs(error) < 1e-4:
+            return target, 0.0
+        limit = self.decel if (level > 0) != (error > 0) and level else self.accel
+        if not limit:
+            return target, 0.0
+        direction = 1.0 if error > 0 else -1.0
+        if self.jerk:
+            wanted = direction * min(limit, (2 * self.jerk * abs(error)) ** 0.5)
+            rate += max(-self.jerk * dt, min(self.jerk * dt, wanted - rate))
+        else:
+            rate = direction * limit
+        level += rate * dt
+        if (target - level) * direction <= 0:
+            return target, 0.0 # Reached, don't overshoot
+        return max(-1.0, min(1.0, level)), rate
+
+class DeviceRecord:
+    """One configured device and the gpiozero object bound to it."""
+    __slots__ = ("id", "name", "type", "role", "pins", "binding", "obj", "profile")
+
+    def __init__(self, dev, obj=None):
+        self.id = dev["id"]
+        self.name = dev.get("name") or dev["id"]
+        self.type = dev.get("type")
+        self.role = dev.get("role") or None
+        self.pins = dict(dev.get("pins") or {})
+        self.binding = device_binding(dev)
+        self.obj = obj
+        self.profile = MotionProfile.from_device(dev) if self.type == "motor" else None
+
+class PeripheralRegistry:
+    """Immutable view of the configured devices, built once per config change.
+
+    by_id, by_role and by_type index the records; motors is every motor
+    object for bulk operations and drive maps the legacy motor ids straight
+    to their objects, so the control loop never builds role names or scans.
+    motor_keys resolves a motor id or role to its control loop key (the
+    legacy id for drive motors, the device id otherwise) and outputs maps
+    those keys to objects, profiles to their MotionProfile. by_pin maps
+    every configured pin to the "id.function" using it, conflicts lists the
+    pins claimed twice. Devices that failed to initialize have no object and
+    are left out of everything but by_id and by_pin.
+    """
+    __slots__ = ("by_id", "by_role", "by_type", "motors", "drive", "motor_keys", "outputs", "profiles",
+                 "by_pin", "conflicts")
+
+    def __init__(self, records=()):
+        self.by_id = {record.id: record for record in records}
+        live = [record for record in records if record.obj is not None]
+        self.by_role = {record.role: record for record in live if record.role}
+        by_type = collections.defaultdict(list)
+        for record in live:
+            by_type[record.type].append(record)
+        self.by_type = {dtype: tuple(group) for dtype, group in by_type.items()}
+        self.motors = tuple(record.obj for record in self.by_type.get("motor", ()))
+        self.drive = {motor_id: self.by_role[role].obj if role in self.by_role else None
+                      for motor_id, role in MOTOR_ROLES.items()}
+        drive_ids = {role: motor_id for motor_id, role in MOTOR_ROLES.items()}
+        self.motor_keys = {}
+        self.outputs = dict(self.drive)
+        self.profiles = {}
+        for record in self.by_type.get("motor", ()):
+            key = drive_ids.get(record.role, record.id)
+            self.motor_keys[record.id] = key
+            if record.role:
+                self.motor_keys[record.role] = key
+            self.outputs.setdefault(key, record.obj)
+            self.profiles.setdefault(key, record.profile)
+        self.by_pin = {}
+        conflicts = []
+        for record in self.by_id.values():
+            for function, pin in record.pins.items():
+                if pin is None:
+                    continue
+                key = str(pin).upper().removeprefix("GPIO")
+                owner = self.by_pin.setdefault(key, f"{record.id}.{function}")
+                if owner != f"{record.id}.{function}":
+                    conflicts.append(f"pin {pin} of {record.id}.{function} is already used by {owner}")
+        self.conflicts = tuple(conflicts)
+
+    def get(self, key):
+        # Device object by id or role
+        record = self.by_id.get(key) or self.by_role.get(key)
+        return record.obj if record else None
+
+def device_binding(dev):
+    # What the hardware object depends on; names and roles can change without touching it
+    return dev.get("type"), tuple(sorted((dev.get("pins") or {}).items()))
+
+def create_device(dev):
+    dtype = dev.get("type")
+    pins = dev.get("pins", {})
+    if dtype == "motor":
+        return Motor(forward=pins["forward"], backward=pins["backward"], enable=pins["enable"])
+    if dtype == "hcsr04":
+        return DistanceSensor(trigger=pins["trigger"], echo=pins["echo"])
+    return None
+
+peripherals = PeripheralRegistry() # Replaced as a whole on reconfiguration
+
+def reconfigure_peripherals():
+    """Bring the devices in line with the config, touching only what changed.
+
+    Devices are matched by id. One whose type or pins changed, or that was
+    removed, is closed; new and changed ones are created; everything else
+    keeps its gpiozero object and only picks up its new name and role. The
+    new registry is built on the side and swapped in with one assignment.
+    Returns a report of what was touched and how long it took.
+    """
+    global peripherals
+    start = time.perf_counter()
+    devices = [dev for dev in state.get("config").get("devices", []) if dev.get("id")]
+    records = [DeviceRecord(dev) for dev in devices]
+    wanted = {record.id: record.binding for record in records}
+    report = {"created": [], "closed": [], "kept": [], "failed": []}
+
+    # Close first: a changed device may hand its pins to another one
+    reusable = {}
+    for old in peripherals.by_id.values():
+        if old.obj is None:
+            continue
+        if wanted.get(old.id) == old.binding:
+            reusable[old.id] = old.obj
+            continue
+        report["closed"].append(old.id)
+        try: old.obj.close()
         except: pass
-    peripherals = {}
 
-    for dev in current_config.get("devices", []):
+    for dev, record in zip(devices, records):
+        if record.id in reusable:
+            record.obj = reusable[record.id]
+            report["kept"].append(record.id)
+            continue
         try:
-            dtype = dev.get("type")
-            pins = dev.get("pins", {})
-            p_obj = None
-            
-            if dtype == "motor":
-                p_obj = Motor(forward=pins["forward"], backward=pins["backward"], enable=pins["enable"])
-            elif dtype == "hcsr04":
-                p_obj = DistanceSensor(trigger=pins["trigger"], echo=pins["echo"])
-            
-            if p_obj:
-                peripherals[dev["id"]] = p_obj
-                if dev.get("role"):
-                    peripherals[dev["role"]] = p_obj
-                log_msg(f"Peripheral initialized: {dev['name']} ({dev['id']})")
+            record.obj = create_device(dev)
+            if record.obj:
+                report["created"].append(record.id)
+                log_msg(f"Peripheral initialized: {record.name} ({record.id})", "config")
         except Exception as e:
-            log_msg(f"Error initializing device {dev.get('name')}: {e}")
+            report["failed"].append(record.id)
+            log_msg(f"Error initializing device {dev.get('name')}: {e}", "config", ERROR)
 
-init_peripherals()
+    peripherals = PeripheralRegistry(records)
+    report["ms"] = round((time.perf_counter() - start) * 1000, 2)
+    return report
 
-current_speed = 0.5 # Default 0.0-1.0
+reconfigure_peripherals()
+for conflict in peripherals.conflicts:
+    log_msg(f"Config has a pin conflict: {conflict}", "config", ERROR)
 
-# --- Global State for Web Interface ---
-BT_STATUS = "Disconnected"
-BT_CLIENT_INFO = None
-BT_DEVICE_NAME = None
 
 def get_bt_device_name(mac):
     try:
@@ -145,19 +702,12 @@ def get_bt_device_name(mac):
             if "Name:" in line:
                 return line.split("Name:")[1].strip()
     except Exception as e:
-        log_msg(f"Error resolving BT name: {e}")
+        log_msg(f"Error resolving BT name: {e}", "bt", WARNING)
     return "Unknown Device"
 
 app = Flask(__name__)
 
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html lang="ru">
-<head>
-    <meta charset="UTF-8">
-    <title>Motor Server Dashboard</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
-    <style>
+DASHBOARD_CSS = """
         :root {
             --primary: #26c6da;
             --primary-dark: #00acc1;
@@ -372,22 +922,6 @@ HTML_TEMPLATE = """
         .action-icon { font-size: 1.5rem; width: 40px; }
         .action-label { font-weight: 600; flex: 1; }
 
-        /* Refresh Control */
-        .refresh-control {
-            position: fixed;
-            bottom: 20px;
-            right: 20px;
-            background: var(--card-bg);
-            padding: 8px 12px;
-            border-radius: 50px;
-            box-shadow: 0 5px 15px rgba(0,0,0,0.1);
-            display: flex;
-            align-items: center;
-            gap: 8px;
-            font-size: 0.8rem;
-            z-index: 100;
-        }
-
         select { border: none; background: #f0f2f5; padding: 4px 8px; border-radius: 10px; font-weight: bold; outline: none; }
 
         .placeholder-text { text-align: center; color: var(--text-sub); padding: 40px 0; }
@@ -543,319 +1077,104 @@ HTML_TEMPLATE = """
         }
         .dropdown-content a:hover { background-color: #f1f1f1; }
         .admin-dropdown:hover .dropdown-content { display: block; }
-    </style>
-</head>
-<body>
-    <div id="terminalModal" class="modal">
-        <div class="modal-content">
-            <div class="modal-header">
-                <span data-t="modal_update_title">System Update</span>
-                <span class="close-btn" onclick="closeTerminal()">&times;</span>
-            </div>
-            <div id="term-update" class="terminal-body"></div>
-        </div>
-    </div>
+"""
 
-    <div id="rebootOverlay" class="reboot-overlay">
-        <div class="spinner"></div>
-        <h2 data-t="rebooting_title">System Rebooting...</h2>
-        <p data-t="rebooting_msg">Please wait while the system starts up. Page will reload automatically.</p>
-    </div>
+DASHBOARD_JS = """
+        const translations = {
+            ru: {
+                app_name: "Control Cortase",
+                tab_control: "Управление",
+                tab_admin: "Администрирование",
+                tab_maps: "Карты",
+                bt_disconnected: "Отключено",
+                btn_update: "Обновить (Deploy)",
+                btn_restart: "Перезагрузить Pi",
+                confirm_restart: "Вы уверены, что хотите перезагрузить устройство?",
+                maps_placeholder: "Карты в разработке...",
+                m_left: "Левый мотор",
+                m_right: "Правый мотор",
+                modal_update_title: "Обновление системы",
+                rebooting_title: "Система перезагружается...",
+                rebooting_msg: "Пожалуйста, подождите. Страница обновится автоматически.",
+                error_update: "Ошибка при запуске обновления",
+                pin_fwd: "Вперед",
+                pin_bwd: "Назад",
+                pin_spd: "Скорость",
+                tab_config: "Конфигурация",
+                tab_config_sensor: "Датчик HC-SR04",
+                btn_scan: "Сканировать HC-SR04",
+                btn_save: "Сохранить и Применить",
+                scanning: "Сканирование...",
+                scan_not_found: "Устройства не найдены",
+                config_saved: "Конфигурация сохранена!"
+            },
+            en: {
+                app_name: "Control Cortase",
+                tab_control: "Control",
+                tab_admin: "Admin",
+                tab_maps: "Maps",
+                bt_disconnected: "Disconnected",
+                btn_update: "Update (Deploy)",
+                btn_restart: "Restart Pi",
+                confirm_restart: "Are you sure you want to restart the device?",
+                maps_placeholder: "Maps under development...",
+                m_left: "Left Motor",
+                m_right: "Right Motor",
+                modal_update_title: "System Update",
+                rebooting_title: "System Rebooting...",
+                rebooting_msg: "Please wait. Page will reload automatically.",
+                error_update: "Error starting update",
+                pin_fwd: "Fwd",
+                pin_bwd: "Bwd",
+                pin_spd: "Spd",
+                tab_config: "Configuration",
+                tab_config_sensor: "HC-SR04 Sensor",
+                btn_scan: "Scan HC-SR04",
+                btn_save: "Save & Apply",
+                scanning: "Scanning...",
+                scan_not_found: "No devices found",
+                config_saved: "Configuration saved!"
+            },
+            es: {
+                app_name: "Control Cortase",
+                tab_control: "Control",
+                tab_admin: "Admin",
+                tab_maps: "Mapas",
+                bt_disconnected: "Desconectado",
+                btn_update: "Actualizar (Deploy)",
+                btn_restart: "Reiniciar Pi",
+                confirm_restart: "¿Está seguro de что desea reiniciar el dispositivo?",
+                maps_placeholder: "Mapas en desarrollo...",
+                m_left: "Motor Izquierdo",
+                m_right: "Motor Derecho",
+                modal_update_title: "Actualización del Sistema",
+                rebooting_title: "Sistema Reiniciando...",
+                rebooting_msg: "Por favor, espere. La página se recargará automáticamente.",
+                error_update: "Error al iniciar la actualización",
+                pin_fwd: "Avance",
+                pin_bwd: "Retro",
+                pin_spd: "Veloc",
+                tab_config: "Configuración",
+                tab_config_sensor: "Sensor HC-SR04",
+                btn_scan: "Escanear HC-SR04",
+                btn_save: "Guardar y Aplicar",
+                scanning: "Escaneando...",
+                scan_not_found: "No se encontraron dispositivos",
+                config_saved: "¡Configuración guardada!"
+            }
+        };
 
-    <div class="header">
-        <div class="lang-switcher">
-            <span class="lang-btn" id="lang-ru" onclick="changeLang('ru')">🇷🇺</span>
-            <span class="lang-btn" id="lang-en" onclick="changeLang('en')">🇺🇸</span>
-            <span class="lang-btn" id="lang-es" onclick="changeLang('es')">🇪🇸</span>
-        </div>
-        <h1 data-t="app_name">Control Cortase</h1>
-        
-        <div class="bt-header-status">
-            <div class="bt-dot {{ 'connected' if connected else '' }}"></div>
-            <div class="device-info-compact">
-                <div class="device-name-header">
-                    {% if connected %}
-                        {{ device_name if device_name else 'MiotLinkAp_DAFA' }}
-                    {% else %}
-                        <span data-t="bt_disconnected">Disconnected</span>
-                    {% endif %}
-                </div>
-                {% if connected and client %}
-                <div class="device-mac-header">{{ client }}</div>
-                {% endif %}
-            </div>
-            <div style="flex: 1; text-align: right;">
-                <div class="admin-dropdown">
-                    <span style="font-size: 1.5rem; opacity: 0.8;">⚙️</span>
-                    <div class="dropdown-content">
-                        <a href="#" onclick="startUpdate()" data-t="btn_update">Update (Deploy)</a>
-                        <a href="#" onclick="confirmRestart()" data-t="btn_restart">Restart Pi</a>
-                    </div>
-                </div>
-            </div>
-        </div>
-    </div>
+        function applyTranslations() {
+            const lang = localStorage.getItem('appLang') || 'ru';
+            const t = translations[lang];
 
-    <div class="nav-tabs">
-        <div class="tab-link active" onclick="showTab('control')" data-t="tab_control">Управление</div>
-        <div class="tab-link" onclick="showTab('config')" data-t="tab_config">Конфигурация</div>
-        <div class="tab-link" onclick="showTab('maps')" data-t="tab_maps">Карты</div>
-    </div>
-
-    <div class="container">
-        <!-- Control Tab -->
-        <div id="control" class="tab-content active">
-            <div class="card">
-                <div class="control-grid">
-                    <button class="ctrl-btn up" onclick="sendCommand('forward')">▲</button>
-                    <button class="ctrl-btn left" onclick="sendCommand('left')">◀</button>
-                    <button class="ctrl-btn stop" onclick="sendCommand('stop')">STOP</button>
-                    <button class="ctrl-btn right" onclick="sendCommand('right')">▶</button>
-                    <button class="ctrl-btn down" onclick="sendCommand('backward')">▼</button>
-                </div>
-                <div class="motor-info">
-                    <div class="motor-side">
-                        <div data-t="m_left">Левый мотор</div>
-                        <div class="motor-pins">
-                            {% if m_left %}
-                                <span data-t="pin_fwd">Fwd</span>:{{ m_left.pins.forward }}, 
-                                <span data-t="pin_bwd">Bwd</span>:{{ m_left.pins.backward }}, 
-                                <span data-t="pin_spd">Spd</span>:{{ m_left.pins.enable }}
-                            {% else %}
-                                <span style="color:red">Role move_left not assigned</span>
-                            {% endif %}
-                        </div>
-                    </div>
-                    <div class="motor-side">
-                        <div data-t="m_right">Правый мотор</div>
-                        <div class="motor-pins">
-                            {% if m_right %}
-                                <span data-t="pin_fwd">Fwd</span>:{{ m_right.pins.forward }}, 
-                                <span data-t="pin_bwd">Bwd</span>:{{ m_right.pins.backward }}, 
-                                <span data-t="pin_spd">Spd</span>:{{ m_right.pins.enable }}
-                            {% else %}
-                                <span style="color:red">Role move_right not assigned</span>
-                            {% endif %}
-                        </div>
-                    </div>
-                </div>
-            </div>
-            <div class="terminal-integrated">
-                <div class="terminal-header">
-                    <span>Terminal / Control</span>
-                    <span id="term-status-control">● Live</span>
-                </div>
-                <div id="term-control"></div>
-            </div>
-        </div>
-
-        <!-- Configuration Tab -->
-        <div id="config" class="tab-content">
-            <div class="config-grid" id="configGrid">
-                {% for dev in sorted_devices %}
-                <div class="config-card {{ 'has-role' if dev.role else '' }}" data-id="{{ dev.id }}" data-type="{{ dev.type }}">
-                    {% if dev.role %}
-                    <div class="role-badge">PRIMARY CONTROL: {{ dev.role }}</div>
-                    {% endif %}
-                    <div class="config-card-header">
-                        <input type="text" class="config-name-input" value="{{ dev.name }}" onchange="markDirty()">
-                        <span class="btn-delete" onclick="deleteDevice('{{ dev.id }}')">&times;</span>
-                    </div>
-                    
-                    {% if dev.type == 'motor' %}
-                    <div class="config-row">
-                        <span class="config-label" data-t="pin_fwd">Вперед</span>
-                        <input type="number" class="config-input" data-pin="forward" value="{{ dev.pins.forward }}">
-                    </div>
-                    <div class="config-row">
-                        <span class="config-label" data-t="pin_bwd">Назад</span>
-                        <input type="number" class="config-input" data-pin="backward" value="{{ dev.pins.backward }}">
-                    </div>
-                    <div class="config-row">
-                        <span class="config-label" data-t="pin_spd">Скорость</span>
-                        <input type="number" class="config-input" data-pin="enable" value="{{ dev.pins.enable }}">
-                    </div>
-                    {% elif dev.type == 'hcsr04' %}
-                    <div class="config-row">
-                        <span class="config-label">Trigger</span>
-                        <input type="number" class="config-input" data-pin="trigger" value="{{ dev.pins.trigger }}">
-                    </div>
-                    <div class="config-row">
-                        <span class="config-label">Echo</span>
-                        <input type="number" class="config-input" data-pin="echo" value="{{ dev.pins.echo }}">
-                    </div>
-                    <button class="btn-scan" onclick="scanHCSR04('{{ dev.id }}')" data-t="btn_scan">Сканировать HC-SR04</button>
-                    <div id="scanResult_{{ dev.id }}" class="scan-result"></div>
-                    {% endif %}
-
-                    {% if dev.role %}
-                    <div style="margin-top: 10px; font-size: 0.7rem; color: var(--text-sub);">
-                        Role: <strong>{{ dev.role }}</strong>
-                    </div>
-                    {% endif %}
-                </div>
-                {% endfor %}
-            </div>
-
-            <div class="add-device-section">
-                <select id="catalogSelect" class="catalog-select">
-                    <option value="motor">New Motor</option>
-                    <option value="hcsr04">New HC-SR04 Sensor</option>
-                </select>
-                <button class="btn-add" onclick="addDevice()">+ Add Device</button>
-            </div>
-
-            <button class="btn-save" onclick="saveConfig()" data-t="btn_save" style="margin-top: 20px;">Сохранить и Применить</button>
-
-            <div class="terminal-integrated">
-                <div class="terminal-header">
-                    <span>Terminal / Configuration</span>
-                    <span id="term-status-config">● Live</span>
-                </div>
-                <div id="term-config"></div>
-            </div>
-        </div>
-
-        <!-- Admin Tab Removed and moved to Header Dropdown -->
-
-        <!-- Maps Tab -->
-        <div id="maps" class="tab-content">
-            <div class="card">
-                <div class="placeholder-text">
-                    <div style="font-size: 3rem; margin-bottom: 10px;">🗺️</div>
-                    <div data-t="maps_placeholder">Карты в разработке...</div>
-                </div>
-            </div>
-        </div>
-    </div>
-
-    <!-- Floating Auto-Refresh -->
-    <div class="refresh-control">
-        <select id="refreshSelect" onchange="updateRefresh()">
-            <option value="0" data-t="off">Off</option>
-            <option value="5" data-t-suffix="s">5s</option>
-            <option value="10" data-t-suffix="s">10s</option>
-            <option value="15" data-t-suffix="s">15s</option>
-            <option value="30" data-t-suffix="s">30s</option>
-            <option value="60" data-t-suffix="m">1m</option>
-            <option value="300" data-t-suffix="m">5m</option>
-        </select>
-    </div>
-
-    <script>
-        const translations = {
-            ru: {
-                app_name: "Control Cortase",
-                tab_control: "Управление",
-                tab_admin: "Администрирование",
-                tab_maps: "Карты",
-                bt_disconnected: "Отключено",
-                btn_update: "Обновить (Deploy)",
-                btn_restart: "Перезагрузить Pi",
-                auto_refresh: "⏱️:",
-                off: "Выкл",
-                s: "с",
-                m: "м",
-                confirm_restart: "Вы уверены, что хотите перезагрузить устройство?",
-                maps_placeholder: "Карты в разработке...",
-                m_left: "Левый мотор",
-                m_right: "Правый мотор",
-                modal_update_title: "Обновление системы",
-                rebooting_title: "Система перезагружается...",
-                rebooting_msg: "Пожалуйста, подождите. Страница обновится автоматически.",
-                error_update: "Ошибка при запуске обновления",
-                pin_fwd: "Вперед",
-                pin_bwd: "Назад",
-                pin_spd: "Скорость",
-                tab_config: "Конфигурация",
-                tab_config_sensor: "Датчик HC-SR04",
-                btn_scan: "Сканировать HC-SR04",
-                btn_save: "Сохранить и Применить",
-                scanning: "Сканирование...",
-                scan_not_found: "Устройства не найдены",
-                config_saved: "Конфигурация сохранена!"
-            },
-            en: {
-                app_name: "Control Cortase",
-                tab_control: "Control",
-                tab_admin: "Admin",
-                tab_maps: "Maps",
-                bt_disconnected: "Disconnected",
-                btn_update: "Update (Deploy)",
-                btn_restart: "Restart Pi",
-                auto_refresh: "⏱️:",
-                off: "Off",
-                s: "s",
-                m: "m",
-                confirm_restart: "Are you sure you want to restart the device?",
-                maps_placeholder: "Maps under development...",
-                m_left: "Left Motor",
-                m_right: "Right Motor",
-                modal_update_title: "System Update",
-                rebooting_title: "System Rebooting...",
-                rebooting_msg: "Please wait. Page will reload automatically.",
-                error_update: "Error starting update",
-                pin_fwd: "Fwd",
-                pin_bwd: "Bwd",
-                pin_spd: "Spd",
-                tab_config: "Configuration",
-                tab_config_sensor: "HC-SR04 Sensor",
-                btn_scan: "Scan HC-SR04",
-                btn_save: "Save & Apply",
-                scanning: "Scanning...",
-                scan_not_found: "No devices found",
-                config_saved: "Configuration saved!"
-            },
-            es: {
-                app_name: "Control Cortase",
-                tab_control: "Control",
-                tab_admin: "Admin",
-                tab_maps: "Mapas",
-                bt_disconnected: "Desconectado",
-                btn_update: "Actualizar (Deploy)",
-                btn_restart: "Reiniciar Pi",
-                auto_refresh: "⏱️:",
-                off: "Apagado",
-                s: "s",
-                m: "m",
-                confirm_restart: "¿Está seguro de что desea reiniciar el dispositivo?",
-                maps_placeholder: "Mapas en desarrollo...",
-                m_left: "Motor Izquierdo",
-                m_right: "Motor Derecho",
-                modal_update_title: "Actualización del Sistema",
-                rebooting_title: "Sistema Reiniciando...",
-                rebooting_msg: "Por favor, espere. La página se recargará automáticamente.",
-                error_update: "Error al iniciar la actualización",
-                pin_fwd: "Avance",
-                pin_bwd: "Retro",
-                pin_spd: "Veloc",
-                tab_config: "Configuración",
-                tab_config_sensor: "Sensor HC-SR04",
-                btn_scan: "Escanear HC-SR04",
-                btn_save: "Guardar y Aplicar",
-                scanning: "Escaneando...",
-                scan_not_found: "No se encontraron dispositivos",
-                config_saved: "¡Configuración guardada!"
-            }
-        };
-
-        function applyTranslations() {
-            const lang = localStorage.getItem('appLang') || 'ru';
-            const t = translations[lang];
-
-            document.querySelectorAll('.lang-btn').forEach(b => b.classList.remove('active'));
-            document.getElementById(`lang-${lang}`).classList.add('active');
+            document.querySelectorAll('.lang-btn').forEach(b => b.classList.remove('active'));
+            document.getElementById(`lang-${lang}`).classList.add('active');
 
             document.querySelectorAll('[data-t]').forEach(el => {
                 const key = el.getAttribute('data-t');
                 if (t[key]) el.textContent = t[key];
             });
-
-            document.querySelectorAll('[data-t-suffix]').forEach(el => {
-                const suffix = el.getAttribute('data-t-suffix');
-                const val = el.value === "60" ? "1" : (el.value === "300" ? "5" : el.value);
-                el.textContent = `${val}${t[suffix]}`;
-            });
         }
 
         function changeLang(lang) {
@@ -873,7 +1192,25 @@ HTML_TEMPLATE = """
             localStorage.setItem('activeTab', id);
         }
 
+        // Drive over one persistent WebSocket when the event hub is up, POST /move otherwise
+        let driveSocket = null;
+        function initDriveSocket() {
+            const hubPort = document.body.dataset.ssePort;
+            if (!hubPort) return;
+            const scheme = location.protocol === 'https:' ? 'wss' : 'ws';
+            driveSocket = new WebSocket(`${scheme}://${location.hostname}:${hubPort}/ws`);
+            driveSocket.onmessage = (e) => console.log('Ack:', e.data);
+            driveSocket.onclose = () => {
+                driveSocket = null;
+                setTimeout(initDriveSocket, 3000);
+            };
+        }
+
         function sendCommand(dir) {
+            if (driveSocket && driveSocket.readyState === WebSocket.OPEN) {
+                driveSocket.send(dir.toUpperCase());
+                return;
+            }
             fetch(`/move/${dir}`, { method: 'POST' })
                 .then(r => console.log('Action:', dir))
                 .catch(e => console.error('Error:', e));
@@ -900,7 +1237,7 @@ HTML_TEMPLATE = """
             ];
 
             if (eventSource) eventSource.close();
-            eventSource = new EventSource('/stream_logs');
+            eventSource = new EventSource(streamUrl('/stream_logs'));
             
             eventSource.onmessage = (e) => {
                 if (e.data === "HEARTBEAT") return;
@@ -914,18 +1251,67 @@ HTML_TEMPLATE = """
             };
 
             eventSource.onerror = (e) => {
+                // The browser reconnects by itself and resumes via Last-Event-ID
                 console.warn("Log stream disconnected, retrying...");
-                eventSource.close();
-                setTimeout(initLogStream, 3000);
+                if (eventSource.readyState === EventSource.CLOSED) setTimeout(initLogStream, 3000);
             };
         }
 
-        // Initialize log stream on load
+        function streamUrl(path) {
+            const hubPort = document.body.dataset.ssePort;
+            return hubPort ? `${location.protocol}//${location.hostname}:${hubPort}${path}` : path;
+        }
+
+        // Server state as of the last render, kept current by /stream_state pushes
+        const header = document.getElementById('btHeader').dataset;
+        const liveState = { bt_status: header.status, bt_device: header.device, bt_client: header.client };
+
+        function renderBtStatus() {
+            const connected = liveState.bt_status === 'Connected';
+            document.getElementById('btDot').classList.toggle('connected', connected);
+            const name = document.getElementById('btName');
+            if (connected) {
+                name.textContent = liveState.bt_device || 'MiotLinkAp_DAFA';
+            } else {
+                const lang = localStorage.getItem('appLang') || 'ru';
+                name.innerHTML = '<span data-t="bt_disconnected"></span>';
+                name.firstChild.textContent = translations[lang].bt_disconnected;
+            }
+            document.getElementById('btMac').textContent = connected && liveState.bt_client ? liveState.bt_client : '';
+        }
+
+        function renderLink() {
+            // Heartbeat quality of the Bluetooth client shown in the header, else of any heartbeat client
+            const links = Object.values(liveState.links || {});
+            const link = links.find(l => l.transport === 'BT' && l.client === liveState.bt_client) || links[0];
+            document.getElementById('btLink').textContent = link && link.rtt_ms !== null
+                ? `RTT ${link.rtt_ms} ms ± ${link.jitter_ms}` + (link.lost ? `, lost ${link.lost}` : '') : '';
+        }
+
+        function initStateStream() {
+            // Deltas since the version this page was rendered from; the browser resumes via Last-Event-ID
+            const stateSource = new EventSource(streamUrl(`/stream_state?since=${document.body.dataset.stateVersion}`));
+            stateSource.onmessage = (e) => {
+                const delta = JSON.parse(e.data);
+                // Device cards are rendered server-side: a changed config (or a restarted server) needs a new page
+                if (delta.full || 'config' in delta.changes) {
+                    location.reload();
+                    return;
+                }
+                Object.assign(liveState, delta.changes);
+                if (['bt_status', 'bt_device', 'bt_client'].some(k => k in delta.changes)) renderBtStatus();
+                if ('links' in delta.changes || 'bt_client' in delta.changes) renderLink();
+            };
+        }
+
+        // Initialize log and state streams on load
         window.addEventListener('load', () => {
             applyTranslations();
             const activeTab = localStorage.getItem('activeTab') || 'control';
             showTab(activeTab);
             initLogStream();
+            initStateStream();
+            initDriveSocket();
         });
 
         function closeTerminal() {
@@ -954,20 +1340,6 @@ HTML_TEMPLATE = """
                 .catch(() => setTimeout(checkServer, 2000));
         }
 
-        let refreshTimer = null;
-        function startRefresh(seconds) {
-            if (refreshTimer) clearInterval(refreshTimer);
-            if (seconds > 0) {
-                refreshTimer = setInterval(() => location.reload(), seconds * 1000);
-            }
-        }
-
-        function updateRefresh() {
-            const val = document.getElementById('refreshSelect').value;
-            localStorage.setItem('refreshInterval', val);
-            startRefresh(parseInt(val));
-        }
-
         function addDevice() {
             const type = document.getElementById('catalogSelect').value;
             const id = "dev_" + Math.random().toString(36).substr(2, 5);
@@ -1071,174 +1443,552 @@ HTML_TEMPLATE = """
 
         window.onload = () => {
             applyTranslations();
-            const savedRefresh = localStorage.getItem('refreshInterval') || "0";
-            document.getElementById('refreshSelect').value = savedRefresh;
-            startRefresh(parseInt(savedRefresh));
-            
+
             const savedTab = localStorage.getItem('activeTab') || 'control';
             showTab(savedTab);
             const activeLink = document.querySelector(`.tab-link[onclick*="${savedTab}"]`);
             if (activeLink) activeLink.classList.add('active');
         };
-    </script>
-</body>
-</html>
 """
 
+HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="ru">
+<head>
+    <meta charset="UTF-8">
+    <title>Motor Server Dashboard</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1, maximum-scale=1, user-scalable=no">
+    <link rel="stylesheet" href="/assets/{{ assets.css }}">
+</head>
+<body data-sse-port="{{ sse_port or '' }}" data-state-version="{{ state_version }}">
+    <div id="terminalModal" class="modal">
+        <div class="modal-content">
+            <div class="modal-header">
+                <span data-t="modal_update_title">System Update</span>
+                <span class="close-btn" onclick="closeTerminal()">&times;</span>
+            </div>
+            <div id="term-update" class="terminal-body"></div>
+        </div>
+    </div>
 
-@app.route('/')
-def index():
-    is_connected = BT_STATUS == "Connected"
-    # Find motors by role for the Control tab display
-    m_left = next((d for d in current_config.get("devices", []) if d.get("role") == "move_left"), None)
-    m_right = next((d for d in current_config.get("devices", []) if d.get("role") == "move_right"), None)
-    
-    # Sort devices so motors with roles are at the top
-    sorted_devices = sorted(current_config.get("devices", []), 
-                           key=lambda x: (x.get("role") is None, x.get("id")))
-
-    return render_template_string(HTML_TEMPLATE, 
-                                status=BT_STATUS, 
-                                client=BT_CLIENT_INFO, 
-                                device_name=BT_DEVICE_NAME, 
-                                connected=is_connected, 
-                                config=current_config,
-                                m_left=m_left,
-                                m_right=m_right,
-                                sorted_devices=sorted_devices)
+    <div id="rebootOverlay" class="reboot-overlay">
+        <div class="spinner"></div>
+        <h2 data-t="rebooting_title">System Rebooting...</h2>
+        <p data-t="rebooting_msg">Please wait while the system starts up. Page will reload automatically.</p>
+    </div>
 
-@app.route('/config', methods=['GET'])
+    <div class="header">
+        <div class="lang-switcher">
+            <span class="lang-btn" id="lang-ru" onclick="changeLang('ru')">🇷🇺</span>
+            <span class="lang-btn" id="lang-en" onclick="changeLang('en')">🇺🇸</span>
+            <span class="lang-btn" id="lang-es" onclick="changeLang('es')">🇪🇸</span>
+        </div>
+        <h1 data-t="app_name">Control Cortase</h1>
+        
+        <div class="bt-header-status" id="btHeader" data-status="{{ status }}" data-device="{{ device_name or '' }}" data-client="{{ client or '' }}">
+            <div class="bt-dot {{ 'connected' if connected else '' }}" id="btDot"></div>
+            <div class="device-info-compact">
+                <div class="device-name-header" id="btName">
+                    {% if connected %}
+                        {{ device_name if device_name else 'MiotLinkAp_DAFA' }}
+                    {% else %}
+                        <span data-t="bt_disconnected">Disconnected</span>
+                    {% endif %}
+                </div>
+                <div class="device-mac-header" id="btMac">{{ client if connected and client else '' }}</div>
+                <div class="device-mac-header" id="btLink"></div>
+            </div>
+            <div style="flex: 1; text-align: right;">
+                <div class="admin-dropdown">
+                    <span style="font-size: 1.5rem; opacity: 0.8;">⚙️</span>
+                    <div class="dropdown-content">
+                        <a href="#" onclick="startUpdate()" data-t="btn_update">Update (Deploy)</a>
+                        <a href="#" onclick="confirmRestart()" data-t="btn_restart">Restart Pi</a>
+                    </div>
+                </div>
+            </div>
+        </div>
+    </div>
+
+    <div class="nav-tabs">
+        <div class="tab-link active" onclick="showTab('control')" data-t="tab_control">Управление</div>
+        <div class="tab-link" onclick="showTab('config')" data-t="tab_config">Конфигурация</div>
+        <div class="tab-link" onclick="showTab('maps')" data-t="tab_maps">Карты</div>
+    </div>
+
+    <div class="container">
+        <!-- Control Tab -->
+        <div id="control" class="tab-content active">
+            <div class="card">
+                <div class="control-grid">
+                    <button class="ctrl-btn up" onclick="sendCommand('forward')">▲</button>
+                    <button class="ctrl-btn left" onclick="sendCommand('left')">◀</button>
+                    <button class="ctrl-btn stop" onclick="sendCommand('stop')">STOP</button>
+                    <button class="ctrl-btn right" onclick="sendCommand('right')">▶</button>
+                    <button class="ctrl-btn down" onclick="sendCommand('backward')">▼</button>
+                </div>
+                <div class="motor-info">
+                    <div class="motor-side">
+                        <div data-t="m_left">Левый мотор</div>
+                        <div class="motor-pins">
+                            {% if m_left %}
+                                <span data-t="pin_fwd">Fwd</span>:{{ m_left.pins.forward }}, 
+                                <span data-t="pin_bwd">Bwd</span>:{{ m_left.pins.backward }}, 
+                                <span data-t="pin_spd">Spd</span>:{{ m_left.pins.enable }}
+                            {% else %}
+                                <span style="color:red">Role move_left not assigned</span>
+                            {% endif %}
+                        </div>
+                    </div>
+                    <div class="motor-side">
+                        <div data-t="m_right">Правый мотор</div>
+                        <div class="motor-pins">
+                            {% if m_right %}
+                                <span data-t="pin_fwd">Fwd</span>:{{ m_right.pins.forward }}, 
+                                <span data-t="pin_bwd">Bwd</span>:{{ m_right.pins.backward }}, 
+                                <span data-t="pin_spd">Spd</span>:{{ m_right.pins.enable }}
+                            {% else %}
+                                <span style="color:red">Role move_right not assigned</span>
+                            {% endif %}
+                        </div>
+                    </div>
+                </div>
+            </div>
+            <div class="terminal-integrated">
+                <div class="terminal-header">
+                    <span>Terminal / Control</span>
+                    <span id="term-status-control">● Live</span>
+                </div>
+                <div id="term-control"></div>
+            </div>
+        </div>
+
+        <!-- Configuration Tab -->
+        <div id="config" class="tab-content">
+            <div class="config-grid" id="configGrid">
+                {% for dev in sorted_devices %}
+                <div class="config-card {{ 'has-role' if dev.role else '' }}" data-id="{{ dev.id }}" data-type="{{ dev.type }}">
+                    {% if dev.role %}
+                    <div class="role-badge">PRIMARY CONTROL: {{ dev.role }}</div>
+                    {% endif %}
+                    <div class="config-card-header">
+                        <input type="text" class="config-name-input" value="{{ dev.name }}" onchange="markDirty()">
+                        <span class="btn-delete" onclick="deleteDevice('{{ dev.id }}')">&times;</span>
+                    </div>
+                    
+                    {% if dev.type == 'motor' %}
+                    <div class="config-row">
+                        <span class="config-label" data-t="pin_fwd">Вперед</span>
+                        <input type="number" class="config-input" data-pin="forward" value="{{ dev.pins.forward }}">
+                    </div>
+                    <div class="config-row">
+                        <span class="config-label" data-t="pin_bwd">Назад</span>
+                        <input type="number" class="config-input" data-pin="backward" value="{{ dev.pins.backward }}">
+                    </div>
+                    <div class="config-row">
+                        <span class="config-label" data-t="pin_spd">Скорость</span>
+                        <input type="number" class="config-input" data-pin="enable" value="{{ dev.pins.enable }}">
+                    </div>
+                    {% elif dev.type == 'hcsr04' %}
+                    <div class="config-row">
+                        <span class="config-label">Trigger</span>
+                        <input type="number" class="config-input" data-pin="trigger" value="{{ dev.pins.trigger }}">
+                    </div>
+                    <div class="config-row">
+                        <span class="config-label">Echo</span>
+                        <input type="number" class="config-input" data-pin="echo" value="{{ dev.pins.echo }}">
+                    </div>
+                    <button class="btn-scan" onclick="scanHCSR04('{{ dev.id }}')" data-t="btn_scan">Сканировать HC-SR04</button>
+                    <div id="scanResult_{{ dev.id }}" class="scan-result"></div>
+                    {% endif %}
+
+                    {% if dev.role %}
+                    <div style="margin-top: 10px; font-size: 0.7rem; color: var(--text-sub);">
+                        Role: <strong>{{ dev.role }}</strong>
+                    </div>
+                    {% endif %}
+                </div>
+                {% endfor %}
+            </div>
+
+            <div class="add-device-section">
+                <select id="catalogSelect" class="catalog-select">
+                    <option value="motor">New Motor</option>
+                    <option value="hcsr04">New HC-SR04 Sensor</option>
+                </select>
+                <button class="btn-add" onclick="addDevice()">+ Add Device</button>
+            </div>
+
+            <button class="btn-save" onclick="saveConfig()" data-t="btn_save" style="margin-top: 20px;">Сохранить и Применить</button>
+
+            <div class="terminal-integrated">
+                <div class="terminal-header">
+                    <span>Terminal / Configuration</span>
+                    <span id="term-status-config">● Live</span>
+                </div>
+                <div id="term-config"></div>
+            </div>
+        </div>
+
+        <!-- Admin Tab Removed and moved to Header Dropdown -->
+
+        <!-- Maps Tab -->
+        <div id="maps" class="tab-content">
+            <div class="card">
+                <div class="placeholder-text">
+                    <div style="font-size: 3rem; margin-bottom: 10px;">🗺️</div>
+                    <div data-t="maps_placeholder">Карты в разработке...</div>
+                </div>
+            </div>
+        </div>
+    </div>
+
+    <script src="/assets/{{ assets.js }}"></script>
+</body>
+</html>
+"""
+
+# --- Dashboard Assets ---
+ASSET_MAX_AGE = 365 * 24 * 3600 # Asset names carry a content hash, so they never change
+
+class StaticAsset:
+    """An in-memory asset, compressed once at startup."""
+
+    def __init__(self, name, body, mimetype):
+        data = body.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()[:12]
+        base, ext = os.path.splitext(name)
+        self.name = f"{base}.{digest}{ext}"
+        self.etag = digest
+        self.mimetype = mimetype
+        self.encodings = {"identity": data, "gzip": gzip.compress(data, 9)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(data)
+
+def negotiate(encodings):
+    # Smallest accepted precompressed variant
+    for name in sorted(encodings, key=lambda enc: len(encodings[enc])):
+        if name == "identity" or request.accept_encodings[name]:
+            return name
+    return "identity"
+
+def send_compressed(encodings, mimetype, etag, cache_control):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        encoding = negotiate(encodings)
+        response = Response(encodings[encoding], mimetype=mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = cache_control
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+ASSETS = {asset.name: asset for asset in (
+    StaticAsset("dashboard.css", DASHBOARD_CSS, "text/css"),
+    StaticAsset("dashboard.js", DASHBOARD_JS, "application/javascript"),
+)}
+ASSET_NAMES = {asset.name.split(".")[-1]: asset.name for asset in ASSETS.values()} # "css"/"js" -> hashed name
+
+dashboard_template = app.jinja_env.from_string(HTML_TEMPLATE) # Compiled once
+dashboard_cache = {"page": (None, None)} # (etag, encodings) of the last render, swapped as a whole
+
+@app.route('/assets/<name>')
+def dashboard_asset(name):
+    asset = ASSETS.get(name)
+    if asset is None:
+        return "Not found", 404
+    return send_compressed(asset.encodings, asset.mimetype, asset.etag,
+                           f"public, max-age={ASSET_MAX_AGE}, immutable")
+
+@app.route('/')
+def index():
+    sse_port = SSE_PORT if event_hub.running else None
+    # The page only depends on the state version, an unchanged state is answered with 304 without rendering
+    etag = hashlib.sha1(repr((state.version, sse_port, ASSET_NAMES)).encode("utf-8")).hexdigest()[:16]
+    cached_etag, encodings = dashboard_cache["page"]
+    if cached_etag != etag:
+        snapshot = state.delta()
+        values = snapshot["changes"]
+        config = values["config"]
+        is_connected = values["bt_status"] == "Connected"
+        # Find motors by role for the Control tab display
+        m_left = next((d for d in config.get("devices", []) if d.get("role") == "move_left"), None)
+        m_right = next((d for d in config.get("devices", []) if d.get("role") == "move_right"), None)
+
+        # Sort devices so motors with roles are at the top
+        sorted_devices = sorted(config.get("devices", []),
+                               key=lambda x: (x.get("role") is None, x.get("id")))
+
+        html = dashboard_template.render(status=values["bt_status"],
+                                         client=values["bt_client"],
+                                         device_name=values["bt_device"],
+                                         connected=is_connected,
+                                         config=config,
+                                         state_version=snapshot["version"],
+                                         m_left=m_left,
+                                         m_right=m_right,
+                                         sorted_devices=sorted_devices,
+                                         sse_port=sse_port,
+                                         assets=ASSET_NAMES).encode("utf-8")
+        encodings = {"identity": html, "gzip": gzip.compress(html, 6)}
+        # Tag what was actually rendered, the state may have moved on meanwhile
+        etag = hashlib.sha1(repr((snapshot["version"], sse_port, ASSET_NAMES)).encode("utf-8")).hexdigest()[:16]
+        dashboard_cache["page"] = (etag, encodings)
+    return send_compressed(encodings, "text/html", etag, "no-cache")
+
+def http_command(verb, arg=None, wait=True):
+    # Run a registered verb for an HTTP request and turn its result into a response.
+    # Slow verbs run as jobs; ?async=1 (or wait=False) returns the job id right away.
+    ctx = CommandContext("http", request.remote_addr)
+    spec = router.commands.get(verb)
+    if spec and spec.blocking:
+        job = submit_command_job(ctx, verb, lambda job_ctx: router.call(verb, arg, job_ctx))
+        if job is None:
+            return jsonify({"status": "error", "message": "Job queue full"}), 503
+        if wait and not request.args.get("async"):
+            wait_futures([job.future], timeout=JOB_HTTP_WAIT)
+        if not job.finished:
+            return jsonify({"status": "accepted", "job": job.id}), 202
+        if job.state == "cancelled" or job.result is None:
+            # Cancelled before it started, there is no result to return
+            return jsonify({"status": "error", "message": "Job cancelled", "job": job.id}), 409
+        result = job.result
+    else:
+        result = router.call(verb, arg, ctx)
+    status = 200 if result.ok else 400
+    if result.data is not None:
+        return jsonify(result.data), status
+    return (result.text or "OK"), status
+
+@app.route('/config', methods=['GET'])
 def get_config():
-    return jsonify(current_config)
+    return http_command("GET_CONFIG")
 
 @app.route('/config/save', methods=['POST'])
 def api_save_config():
-    global current_config
-    new_config = request.json
-    save_config(new_config)
-    current_config = new_config
-    init_peripherals()
-    return jsonify({"status": "success"})
+    return http_command("SAVE_CONFIG", request.json)
 
 @app.route('/config/scan', methods=['POST'])
 def api_scan_sensor():
-    import time
-    from gpiozero import DigitalOutputDevice, DigitalInputDevice
-    
-    results = []
-    # Simplified scan for demo - in reality, we'd loop through possible GPIO pins
-    # Common Trigger/Echo candidates
-    candidates = [14, 15, 18, 23, 24, 25, 8, 7, 12, 16, 20, 21]
-    
-    # Let's say we only check a few pairs to avoid hanging
-    for trig in [20]:
-        for echo in [21]:
-            try:
-                t = DigitalOutputDevice(trig)
-                e = DigitalInputDevice(echo, pull_up=False)
-                
-                t.on()
-                time.sleep(0.00001)
-                t.off()
-                
-                start = time.time()
-                timeout = start + 0.1
-                while e.value == 0 and time.time() < timeout: pass
-                pulse_start = time.time()
-                while e.value == 1 and time.time() < timeout: pass
-                pulse_end = time.time()
-                
-                t.close()
-                e.close()
-                
-                if pulse_end - pulse_start > 0:
-                    results.append({"trigger": trig, "echo": echo})
-            except:
-                pass
-                
-    return jsonify({"status": "success", "results": results})
+    return http_command("SCAN_CONFIG")
 
 @app.route('/move/<direction>', methods=['POST'])
 def move(direction):
-    process_movement_cmd(direction.upper())
-    return "OK", 200
-
-def process_movement_cmd(cmd):
-    msg = f"Movement CMD: {cmd}"
-    log_msg(msg)
-    if cmd == "FORWARD":
-        set_motor(1, "FORWARD")
-        set_motor(2, "FORWARD")
-    elif cmd == "BACKWARD":
-        set_motor(1, "BACKWARD")
-        set_motor(2, "BACKWARD")
-    elif cmd == "LEFT":
-        set_motor(1, "BACKWARD")
-        set_motor(2, "FORWARD")
-    elif cmd == "RIGHT":
-        set_motor(1, "FORWARD")
-        set_motor(2, "BACKWARD")
-    elif cmd == "STOP":
-        set_motor(1, "STOP")
-        set_motor(2, "STOP")
-    elif cmd == "M1_FORWARD": set_motor(1, "FORWARD")
-    elif cmd == "M1_BACKWARD": set_motor(1, "BACKWARD")
-    elif cmd == "M1_STOP": set_motor(1, "STOP")
-    elif cmd == "M2_FORWARD": set_motor(2, "FORWARD")
-    elif cmd == "M2_BACKWARD": set_motor(2, "BACKWARD")
-    elif cmd == "M2_STOP": set_motor(2, "STOP")
+    verb = direction.upper()
+    if verb not in MOVEMENTS:
+        return "Unknown direction", 400
+    return http_command(verb)
+
+@app.route('/drive', methods=['POST'])
+def drive():
+    # {"x": turn, "y": throttle}, same as DRIVE:<x>,<y>
+    body = request.get_json(silent=True)
+    try:
+        vector = parse_drive(f"{float(body['x'])},{float(body['y'])}")
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": f"expected {{\"x\": <-1..1>, \"y\": <-1..1>}}: {e}"}), 400
+    return http_command("DRIVE", vector)
+
+@app.route('/motors', methods=['POST'])
+def set_motors():
+    # {"m1": 0.6, "m2": -0.4}, same rules as MOTORS:
+    body = request.get_json(silent=True)
+    try:
+        pairs = [(str(name), float(value)) for name, value in body.items()]
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({"status": "error", "message": "expected {\"<motor>\": <value>, ...}"}), 400
+    return http_command("MOTORS", pairs)
+
+@app.route('/macros', methods=['GET'])
+def list_macros():
+    return http_command("MACRO_LIST")
+
+@app.route('/macros', methods=['POST'])
+def upload_macro():
+    try:
+        macro = check_macro(request.get_json(silent=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return http_command("MACRO_UPLOAD", macro)
+
+@app.route('/macros/<name>/run', methods=['POST'])
+def run_macro(name):
+    return http_command("MACRO_RUN", name)
+
+@app.route('/macros/abort', methods=['POST'])
+def abort_macro():
+    return http_command("MACRO_ABORT")
+
+@app.route('/macros/<name>', methods=['DELETE'])
+def delete_macro(name):
+    return http_command("MACRO_DELETE", name)
 
 @app.route('/update', methods=['POST'])
 def update():
-    global is_updating
-    if is_updating:
-        return "Update already in progress", 400
-    
-    def run_update():
-        global is_updating
-        is_updating = True
+    return http_command("UPDATE", wait=False)
+
+@app.route('/log_levels', methods=['GET', 'POST'])
+def log_levels_route():
+    if request.method == 'POST':
+        return http_command("LOG_LEVEL", request.json or {})
+    return http_command("LOG_LEVEL", {})
+
+@app.route('/stats/logs')
+def log_stats():
+    return http_command("LOG_STATS")
+
+@app.route('/logs')
+def query_logs():
+    # /logs?since=<seq>&limit=N or /logs?from=<unix ts>&to=<unix ts>&limit=N
+    try:
+        query = log_query(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return http_command("LOGS", query)
+
+@app.route('/jobs')
+def list_jobs():
+    return http_command("JOBS")
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    return http_command("JOB_STATUS", job_id)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    return http_command("JOB_CANCEL", job_id)
+
+@app.route('/stats/commands')
+def command_stats():
+    return http_command("CMD_STATS")
+
+@app.route('/stats/udp')
+def udp_stats():
+    return http_command("UDP_STATS")
+
+@app.route('/stats/link')
+def link_stats():
+    return http_command("LINK_STATS")
+
+@app.route('/stats/scheduler')
+def scheduler_stats():
+    return http_command("SCHED_STATS")
+
+def log_frame(first, entries, dropped=0):
+    # One SSE event for a batch of log lines, id is the last sequence number in it
+    lines = [f"[{dropped} log lines dropped]"] if dropped else []
+    lines.extend(msg for _, msg in entries)
+    data = "".join(f"data: {part}\n" for line in lines for part in line.split("\n"))
+    return f"id: {first + len(entries) - 1}\n{data}\n"
+
+def log_replay(resume, upto, limit=LOG_PAGE_MAX):
+    """Return (dropped, first_seq, entries) covering lines resume..upto-1.
+
+    Lines still in the ring come from memory, older ones from the disk store.
+    """
+    entries = []
+    cursor = resume
+    oldest = log_manager.oldest()
+    if cursor < oldest:
+        for rec in log_store.query(since=cursor - 1, limit=limit):
+            if rec["seq"] >= min(oldest, upto):
+                break
+            if not entries:
+                resume = rec["seq"]
+            entries.append((rec["ts"], rec["msg"]))
+            cursor = rec["seq"] + 1
+    dropped = 0
+    if cursor < oldest:
+        dropped = min(oldest, upto) - cursor
+        if not entries:
+            resume = min(oldest, upto)
+        cursor = oldest
+    if cursor < upto:
+        listener = log_manager.add_listener(replay=0)
         try:
-            process = subprocess.Popen(["./deploy.sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, shell=False)
-            for line in process.stdout:
-                log_msg(line.strip())
-            process.wait()
-            log_msg("DONE")
-        except Exception as e:
-            log_msg(f"ERROR: {e}")
-            log_msg("DONE")
+            log_manager.seek(listener, cursor)
+            while listener.cursor < upto:
+                first, batch = log_manager.read(listener)
+                if not batch:
+                    break
+                if not entries:
+                    resume = first
+                entries.extend(batch[:upto - first])
+            dropped += listener.dropped
         finally:
-            is_updating = False
+            log_manager.remove_listener(listener)
+    return dropped, resume, entries[-limit:]
 
-    threading.Thread(target=run_update).start()
-    return "OK", 200
+def stream_host():
+    # request.host without its port, the log stream hub listens on SSE_PORT of the same host
+    host = request.host
+    if not host.endswith("]") and ":" in host:
+        host = host.rpartition(":")[0]
+    return host
 
 @app.route('/stream_logs')
 def stream_logs():
+    if event_hub.running:
+        # Viewers are served by the event loop hub instead of pinning a Flask thread each
+        url = f"{request.scheme}://{stream_host()}:{SSE_PORT}/stream_logs"
+        return redirect(url, code=307)
+    # Fallback when the hub could not bind its port: one thread per viewer
+    last_id = request.headers.get("Last-Event-ID", "")
     def generate():
-        q = log_manager.add_listener()
+        listener = log_manager.add_listener(replay=0)
+        upto = listener.cursor
+        resume = int(last_id) + 1 if last_id.isdigit() else upto - log_manager.history
+        reported = 0
         try:
+            dropped, first, entries = log_replay(max(0, resume), upto)
+            if entries or dropped:
+                yield log_frame(first, entries, dropped)
             while True:
-                try:
-                    line = q.get(timeout=20)
-                    yield f"data: {line}\n\n"
-                except queue.Empty:
+                first, entries = log_manager.read(listener, timeout=SSE_HEARTBEAT)
+                if not entries:
                     yield "data: HEARTBEAT\n\n"
+                    continue
+                yield log_frame(first, entries, listener.dropped - reported)
+                reported = listener.dropped
         finally:
-            log_manager.remove_listener(q)
+            log_manager.remove_listener(listener)
+    return Response(generate(), mimetype='text/event-stream')
+
+def state_frame(delta):
+    return f"id: {delta['version']}\ndata: {json.dumps(delta)}\n\n"
+
+@app.route('/state')
+def get_state():
+    # /state?since=<version>: only the fields changed after that version
+    since = request.args.get("since", "0")
+    if not since.isdigit():
+        return jsonify({"status": "error", "message": "since must be a version number"}), 400
+    return http_command("STATE", int(since))
+
+@app.route('/stream_state')
+def stream_state():
+    if event_hub.running:
+        url = f"{request.scheme}://{stream_host()}:{SSE_PORT}/stream_state"
+        if request.query_string:
+            url += "?" + request.query_string.decode("latin-1")
+        return redirect(url, code=307)
+    since = request.headers.get("Last-Event-ID") or request.args.get("since", "")
+    def generate():
+        version = int(since) if since.isdigit() else 0
+        while True:
+            delta = state.delta(version)
+            if delta["changes"]:
+                version = delta["version"]
+                yield state_frame(delta)
+            elif state.wait(version, timeout=SSE_HEARTBEAT) == version:
+                yield ": heartbeat\n\n"
     return Response(generate(), mimetype='text/event-stream')
 
 @app.route('/restart', methods=['POST'])
 def restart():
-    try:
-        def do_reboot():
-            import time
-            time.sleep(1) # Delay to allow Flask to return response
-            subprocess.run(["sudo", "reboot"])
-            
-        threading.Thread(target=do_reboot).start()
-        return "OK", 200
-    except Exception as e:
-        return f"Error: {e}", 500
+    return http_command("RESTART")
 
 def run_flask():
     # Run on all interfaces, port 5000
@@ -1248,371 +1998,2557 @@ def map_speed(val255):
     # Map 0-255 value to 0.0-1.0 for gpiozero
     return max(0.0, min(1.0, val255 / 255.0))
 
-def set_motor(motor_id, direction):
-    # motor_id 1 = move_left, motor_id 2 = move_right (legacy support)
-    role = "move_left" if motor_id == 1 else "move_right"
-    motor = peripherals.get(role)
-    
-    if not motor:
-        log_msg(f"No motor with role {role} found")
-        return
-
-    if direction == "FORWARD":
-        motor.forward(current_speed)
-    elif direction == "BACKWARD":
-        motor.backward(current_speed)
-    elif direction == "STOP":
-        motor.stop()
+# --- Motor Control Loop ---
+CONTROL_RATE_HZ = 100 # Default tick rate, "control_rate_hz" in config.json overrides it
 
-def process_update_bt(sock):
-    global is_updating
-    is_updating = True
-    try:
-        process = subprocess.Popen(["./deploy.sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, shell=False)
-        for line in process.stdout:
-            log_msg(line.strip())
-            try:
-                sock.send((line.strip() + "\n").encode())
-            except:
-                pass # Client might have closed
-        process.wait()
-        log_msg("DONE")
-        try: sock.send("DONE\n".encode())
-        except: pass
-    except Exception as e:
-        err = f"ERROR: {e}"
-        log_msg(err)
-        try: sock.send((err + "\n").encode())
-        except: pass
-        log_msg("DONE")
-        try: sock.send("DONE\n".encode())
-        except: pass
-    finally:
-        is_updating = False
+class MotorController:
+    """Fixed-rate motor output loop with latest-wins command coalescing.
 
-def server_loop():
-    global BT_STATUS, BT_CLIENT_INFO, BT_DEVICE_NAME, current_config
+    Motion commands only update the target state (direction per motor, plus
+    the shared speed in state). The loop thread wakes up on a change, waits for
+    the next tick boundary and applies the newest target once, so a burst of
+    SPEED/FORWARD messages between two ticks costs a single GPIO update.
+    Each motor ramps toward its target within its MotionProfile limits; the
+    loop keeps ticking at the fixed rate until every motor has arrived, then
+    sleeps again. Values equal to what was last written are skipped.
 
-    # Use standard socket instead of PyBluez
-    server_sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
-    
-    # Bind to any adapter on channel 1
-    
-    try:
-        server_sock.bind((socket.BDADDR_ANY, 1))
-    except PermissionError:
-        print("Error: Permission denied. Try running with sudo.")
-        return
-    except OSError as e:
-        print(f"Error binding to port: {e}")
-        return
+    stop() bypasses the loop and the ramps and writes zero to the motors
+    immediately; M1_STOP/M2_STOP still ramp down. set_outputs() gives a motor
+    an absolute signed value (analog drive) until its next direction command;
+    besides the legacy drive ids 1 and 2 it takes the device id of any other
+    configured motor (see PeripheralRegistry.motor_keys).
+    """
 
-    server_sock.listen(1)
+    def __init__(self, rate_hz=CONTROL_RATE_HZ):
+        self.period = 1.0 / rate_hz
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.directions = {motor_id: "STOP" for motor_id in MOTOR_ROLES}
+        self.outputs = {} # motor_id -> absolute value -1.0..1.0, overrides the direction
+        self.applied = {} # motor_id -> (gpiozero object or None, value last written)
+        self.levels = {} # motor_id -> current output on its way to the target
+        self.rates = {} # motor_id -> current rate of change, per second
+        self.ramping = False
+        self.ticks = 0
+        self.writes = 0
+        self.thread = None
 
-    port = 1 # We explicitly bound to channel 1
-    
-    print(f"Waiting for connection on RFCOMM channel {port}...")
-    print("Ensure your Android app is connecting to this device's MAC address on UUID/Channel 1")
-    
-    
-    while True:
+    def configure(self, config):
         try:
-            client_sock, client_info = server_sock.accept()
-            log_msg(f"Accepted connection from {client_info}")
-            BT_STATUS = "Connected"
-            mac = client_info[0]
-            BT_CLIENT_INFO = mac
-            BT_DEVICE_NAME = get_bt_device_name(mac)
-            
-            try:
-                while True:
-                    data = client_sock.recv(1024)
-                    if not data:
-                        break
-                    
-                    try:
-                        cmd_str = data.decode("utf-8").strip()
-                    except:
-                        log_msg("Decode error")
-                        continue
-                        
-                    log_msg(f"Received from BT: {cmd_str}")
-                    
-                    # Protocol Handling
-                    if cmd_str.startswith("SPEED:"):
-                        global current_speed
-                        try:
-                            val = int(cmd_str.split(":")[1])
-                            current_speed = map_speed(val)
-                            # Re-apply current speed to active motors
-                            for p in peripherals.values():
-                                if isinstance(p, Motor) and p.is_active:
-                                    p.value = (p.value / abs(p.value)) * current_speed if p.value != 0 else 0
-                            log_msg(f"Speed set to {current_speed*100}%")
-                        except ValueError:
-                            log_msg("Invalid Speed Value")
-                    elif cmd_str == "UPDATE":
-                        log_msg("Update requested via BT")
-                        if not is_updating:
-                            threading.Thread(target=process_update_bt, args=(client_sock,), daemon=True).start()
-                        else:
-                            client_sock.send("Update already in progress\n".encode())
-                    elif cmd_str == "RESTART":
-                        log_msg("Restart requested via BT")
-                        def do_reboot():
-                            import time
-                            time.sleep(1)
-                            subprocess.run(["sudo", "reboot"])
-                        threading.Thread(target=do_reboot, daemon=True).start()
-                        try:
-                            client_sock.send("REBOOTING\n".encode())
-                        except:
-                            pass
-                    elif cmd_str == "GET_CONFIG":
-                        log_msg(f"Config requested via BT from {BT_CLIENT_INFO}")
-                        cfg_str = json.dumps(current_config)
-                        log_msg(f"Sending config (len={len(cfg_str)})")
-                        client_sock.send((cfg_str + "\n").encode())
-                    elif cmd_str.startswith("SAVE_CONFIG:"):
-                        log_msg("Config save requested via BT")
-                        try:
-                            config_json = cmd_str.split("SAVE_CONFIG:")[1]
-                            new_config = json.loads(config_json)
-                            save_config(new_config)
-                            current_config = new_config
-                            init_peripherals()
-                            client_sock.send("CONFIG_SAVED\n".encode())
-                            log_msg("Config saved and peripherals re-initialized")
-                        except Exception as e:
-                            client_sock.send(f"ERROR_SAVING_CONFIG:{e}\n".encode())
-                    elif cmd_str == "SCAN_CONFIG":
-                        log_msg("Scan requested via BT")
-                        # We recycle the scan logic from api_scan_sensor
-                        import time
-                        from gpiozero import DigitalOutputDevice, DigitalInputDevice
-                        results = []
-                        # For brevity in BT loop, just check the default/current sensor pins
-                        trig, echo = 20, 21
-                        try:
-                            t = DigitalOutputDevice(trig)
-                            e = DigitalInputDevice(echo, pull_up=False)
-                            t.on()
-                            time.sleep(0.00001)
-                            t.off()
-                            start = time.time()
-                            timeout = start + 0.1
-                            while e.value == 0 and time.time() < timeout: pass
-                            pulse_start = time.time()
-                            while e.value == 1 and time.time() < timeout: pass
-                            pulse_end = time.time()
-                            t.close()
-                            e.close()
-                            if pulse_end - pulse_start > 0:
-                                results.append({"trigger": trig, "echo": echo})
-                        except: pass
-                        client_sock.send((json.dumps({"status": "success", "results": results}) + "\n").encode())
-                    elif cmd_str == "WIFI_SCAN":
-                        log_msg("WiFi scan requested via BT")
-                        try:
-                            # Use nmcli to scan for WiFi networks
-                            # First trigger a rescan
-                            subprocess.run(["nmcli", "dev", "wifi", "rescan"], capture_output=True, timeout=5)
-                            import time
-                            time.sleep(2)  # Wait for scan to complete
-                            
-                            result = subprocess.run(["nmcli", "-t", "-f", "SSID,SIGNAL,SECURITY", "dev", "wifi", "list"], 
-                                                  capture_output=True, text=True, timeout=10)
-                            networks = []
-                            seen_ssids = set()
-                            
-                            log_msg(f"nmcli output:\n{result.stdout}")
-                            
-                            for line in result.stdout.strip().split("\n"):
-                                if line:
-                                    parts = line.split(":")
-                                    if len(parts) >= 2:
-                                        ssid = parts[0].strip()
-                                        if not ssid or ssid in seen_ssids:
-                                            continue
-                                        seen_ssids.add(ssid)
-                                        
-                                        signal = int(parts[1]) if parts[1].isdigit() else -100
-                                        # Security can have multiple values separated by spaces
-                                        security = parts[2].strip() if len(parts) >= 3 and parts[2].strip() else "Open"
-                                        
-                                        # Convert signal percentage to dBm (approximate)
-                                        signal_dbm = -100 + (signal // 2)
-                                        networks.append({"ssid": ssid, "signal": signal_dbm, "security": security})
-                            
-                            response = json.dumps({"networks": networks})
-                            client_sock.send((response + "\n").encode())
-                            log_msg(f"WiFi scan complete: {len(networks)} networks found")
-                        except Exception as e:
-                            error_response = json.dumps({"error": str(e), "networks": []})
-                            client_sock.send((error_response + "\n").encode())
-                            log_msg(f"WiFi scan error: {e}")
-                    elif cmd_str.startswith("WIFI_CONNECT:"):
-                        log_msg("WiFi connect requested via BT")
-                        try:
-                            config_json = cmd_str.split("WIFI_CONNECT:")[1]
-                            wifi_config = json.loads(config_json)
-                            ssid = wifi_config.get("ssid")
-                            password = wifi_config.get("password", "")
-                            
-                            log_msg(f"Attempting to connect to: {ssid}")
-                            
-                            # First, disconnect from any active WiFi connection
-                            active_result = subprocess.run(["nmcli", "-t", "-f", "NAME,TYPE", "con", "show", "--active"],
-                                                          capture_output=True, text=True, timeout=5)
-                            for line in active_result.stdout.strip().split("\n"):
-                                if line:
-                                    parts = line.split(":")
-                                    if len(parts) >= 2 and "wireless" in parts[1].lower():
-                                        active_wifi = parts[0]
-                                        if active_wifi != ssid:  # Don't disconnect if already connected to target
-                                            log_msg(f"Disconnecting from current WiFi: {active_wifi}")
-                                            subprocess.run(["nmcli", "con", "down", active_wifi], 
-                                                         capture_output=True, timeout=5)
-                                        break
-                            
-                            # Try to connect using nmcli
-                            # For secured networks, we need to specify the key-mgmt
-                            if password:
-                                # Try WPA-PSK first (most common)
-                                result = subprocess.run([
-                                    "nmcli", "dev", "wifi", "connect", ssid, 
-                                    "password", password
-                                ], capture_output=True, text=True, timeout=20)
-                                
-                                # If that fails, try creating a connection profile explicitly
-                                if result.returncode != 0:
-                                    log_msg(f"First attempt failed: {result.stderr}")
-                                    # Delete any existing connection with same name
-                                    subprocess.run(["nmcli", "con", "delete", ssid], capture_output=True)
-                                    
-                                    # Create new connection
-                                    result = subprocess.run([
-                                        "nmcli", "con", "add", 
-                                        "type", "wifi",
-                                        "con-name", ssid,
-                                        "ssid", ssid,
-                                        "wifi-sec.key-mgmt", "wpa-psk",
-                                        "wifi-sec.psk", password
-                                    ], capture_output=True, text=True, timeout=10)
-                                    
-                                    if result.returncode == 0:
-                                        # Activate the connection
-                                        result = subprocess.run([
-                                            "nmcli", "con", "up", ssid
-                                        ], capture_output=True, text=True, timeout=15)
-                            else:
-                                # Open network
-                                result = subprocess.run([
-                                    "nmcli", "dev", "wifi", "connect", ssid
-                                ], capture_output=True, text=True, timeout=15)
-                            
-                            if result.returncode == 0:
-                                response = json.dumps({"status": "connected", "ssid": ssid})
-                                log_msg(f"Connected to WiFi: {ssid}")
-                            else:
-                                error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
-                                response = json.dumps({"status": "failed", "error": error_msg})
-                                log_msg(f"WiFi connection failed: {error_msg}")
-                            
-                            client_sock.send((response + "\n").encode())
-                        except Exception as e:
-                            error_response = json.dumps({"status": "failed", "error": str(e)})
-                            client_sock.send((error_response + "\n").encode())
-                            log_msg(f"WiFi connect error: {e}")
-                    elif cmd_str == "WIFI_STATUS":
-                        log_msg("WiFi status requested via BT")
-                        try:
-                            # Get current WiFi connection
-                            result = subprocess.run(["nmcli", "-t", "-f", "ACTIVE,SSID,SIGNAL", "dev", "wifi"],
-                                                  capture_output=True, text=True, timeout=5)
-                            connected = False
-                            ssid = ""
-                            signal = 0
-                            
-                            for line in result.stdout.strip().split("\n"):
-                                if line.startswith("yes:"):
-                                    parts = line.split(":")
-                                    if len(parts) >= 3:
-                                        connected = True
-                                        ssid = parts[1]
-                                        signal = int(parts[2]) if parts[2].isdigit() else 0
-                                        signal = -100 + (signal // 2)  # Convert to dBm
-                                        break
-                            
-                            response = json.dumps({"connected": connected, "ssid": ssid, "signal": signal})
-                            client_sock.send((response + "\n").encode())
-                            log_msg(f"WiFi status: {'Connected to ' + ssid if connected else 'Not connected'}")
-                        except Exception as e:
-                            error_response = json.dumps({"connected": False, "error": str(e)})
-                            client_sock.send((error_response + "\n").encode())
-                            log_msg(f"WiFi status error: {e}")
-                    elif cmd_str == "WIFI_DISCONNECT":
-                        log_msg("WiFi disconnect requested via BT")
-                        try:
-                            # First, find the active WiFi connection name
-                            result = subprocess.run(["nmcli", "-t", "-f", "NAME,TYPE", "con", "show", "--active"],
-                                                  capture_output=True, text=True, timeout=5)
-                            
-                            wifi_connection = None
-                            for line in result.stdout.strip().split("\n"):
-                                if line:
-                                    parts = line.split(":")
-                                    if len(parts) >= 2 and "wireless" in parts[1].lower():
-                                        wifi_connection = parts[0]
-                                        break
-                            
-                            if wifi_connection:
-                                # Disconnect the active WiFi connection
-                                result = subprocess.run(["nmcli", "con", "down", wifi_connection],
-                                                      capture_output=True, text=True, timeout=5)
-                                
-                                if result.returncode == 0:
-                                    response = json.dumps({"status": "disconnected"})
-                                    log_msg(f"Disconnected from WiFi: {wifi_connection}")
-                                else:
-                                    response = json.dumps({"status": "failed", "error": result.stderr.strip()})
-                                    log_msg(f"WiFi disconnect failed: {result.stderr.strip()}")
-                            else:
-                                response = json.dumps({"status": "disconnected", "message": "No active WiFi connection"})
-                                log_msg("No active WiFi connection to disconnect")
-                            
-                            client_sock.send((response + "\n").encode())
-                        except Exception as e:
-                            error_response = json.dumps({"status": "failed", "error": str(e)})
-                            client_sock.send((error_response + "\n").encode())
-                            log_msg(f"WiFi disconnect error: {e}")
-                    else:
-                        process_movement_cmd(cmd_str)
-                    
-            except IOError:
-                log_msg("Connection disconnected")
-                BT_STATUS = "Disconnected"
-                BT_CLIENT_INFO = None
-                BT_DEVICE_NAME = None
-            
-            client_sock.close()
-            log_msg("Client closed. Waiting for new connection...")
-            # Stop motors on disconnect for safety
-            set_motor(1, "STOP")
-            set_motor(2, "STOP")
-            
-        except KeyboardInterrupt:
-            print("Stopping Server")
-            break
+            rate = float(config.get("control_rate_hz", CONTROL_RATE_HZ))
+        except (TypeError, ValueError):
+            rate = CONTROL_RATE_HZ
+        self.period = 1.0 / max(1.0, min(1000.0, rate))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="motor-control", daemon=True)
+        self.thread.start()
+
+    def set_directions(self, directions):
+        # directions: one entry per legacy motor id, None leaves that motor alone
+        with self.lock:
+            for motor_id, direction in enumerate(directions, 1):
+                if direction:
+                    self.directions[motor_id] = direction
+                    self.outputs.pop(motor_id, None)
+        self.changed.set()
+
+    def set_outputs(self, outputs):
+        # outputs: {motor_id: -1.0..1.0}, applied together on the next tick
+        with self.lock:
+            self.outputs.update(outputs)
+        self.changed.set()
+
+    def request_apply(self):
+        # Target speed changed (state "speed"), re-apply on the next tick
+        self.changed.set()
+
+    def moving(self):
+        with self.lock:
+            return (any(direction != "STOP" for direction in self.directions.values())
+                    or any(self.outputs.values()) or any(self.levels.values()))
+
+    def stop(self):
+        with self.lock:
+            for motor_id in self.directions:
+                self.directions[motor_id] = "STOP"
+            self.outputs.clear()
+            self.levels.clear()
+            self.rates.clear()
+            self.ramping = self._apply(None)
+            # The bulk stop below zeroes every output, so the next write to any of them is not a duplicate
+            self.applied.update((key, (motor, 0.0)) for key, motor in peripherals.outputs.items())
+        for motor in peripherals.motors:
+            # Emergency stop covers motors without a drive role as well
+            try:
+                if motor.value:
+                    motor.stop()
+            except Exception as e:
+                log_msg(f"Motor stop failed: {e}", "control", ERROR)
+
+    def _run(self):
+        next_tick = last_tick = time.monotonic()
+        while True:
+            self.changed.wait()
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.changed.clear()
+            now = time.monotonic()
+            # A ramp starting from idle takes one nominal tick; a late tick never ramps faster than the limits
+            dt = min(now - last_tick, 2 * self.period) if self.ramping else self.period
+            with self.lock:
+                self.ramping = self._apply(dt)
+            if self.ramping:
+                self.changed.set()
+            self.ticks += 1
+            last_tick = now
+            next_tick = now + self.period
+
+    def _apply(self, dt):
+        # Caller holds self.lock; dt None jumps straight to the targets. True while any motor still ramps.
+        speed = state.get("speed")
+        targets = []
+        for motor_id, direction in self.directions.items():
+            if motor_id in self.outputs:
+                value = self.outputs[motor_id]
+            elif direction == "FORWARD":
+                value = speed
+            elif direction == "BACKWARD":
+                value = -speed
+            else:
+                value = 0.0
+            targets.append((motor_id, peripherals.drive.get(motor_id), value, MOTOR_ROLES[motor_id]))
+        for key, value in self.outputs.items():
+            if key not in self.directions:
+                targets.append((key, peripherals.outputs.get(key), value, key))
+        ramping = False
+        profiles = peripherals.profiles
+        for key, motor, target, name in targets:
+            profile = profiles.get(key)
+            if dt is None or profile is None:
+                level = target
+            else:
+                level, self.rates[key] = profile.step(self.levels.get(key, 0.0), self.rates.get(key, 0.0), target, dt)
+            self.levels[key] = level
+            ramping = ramping or level != target
+            self._write(key, motor, level, name)
+        return ramping
+
+    def _write(self, key, motor, value, name):
+        if self.applied.get(key) == (motor, value):
+            return
+        self.applied[key] = (motor, value)
+        if not motor:
+            log_msg(f"No motor with role {name} found", "control", WARNING)
+            return
+        try:
+            motor.value = value
+            self.writes += 1
+        except Exception as e:
+            log_msg(f"Motor {name} write failed: {e}", "control", ERROR)
+
+motor_controller = MotorController()
+motor_controller.configure(state.get("config"))
+motor_controller.start()
+
+# --- Command Router ---
+class CommandContext:
+    """Where a command came from: transport name, client id and an optional reply channel.
+
+    Commands running as background jobs get a child context bound to their Job,
+    which adds progress reporting and cooperative cancellation.
+    """
+
+    def __init__(self, transport, client=None, send=None, job=None):
+        self.transport = transport
+        self.client = client
+        self.send_line = send
+        self.job = job
+        self.job_events = False # Client asked for JOB:<id>:... frames (JOB_EVENTS:ON)
+        self.binary = False # Client switched to binary frames (HELLO:1,binary)
+        self.link = None # LinkMonitor of stream connections, heartbeat is off until HEARTBEAT:ON
+        self.playout = None # PlayoutBuffer for timestamped AT:<client ms>:<command> lines
+        self.driving = False # Sent a motion command; only then does losing this client stop the motors
+
+    def send(self, line, droppable=False):
+        # Push an extra line to the client (progress output); no-op for HTTP.
+        # droppable lines may be discarded when the client is not keeping up.
+        if self.send_line:
+            try:
+                self.send_line(line, droppable)
+            except Exception:
+                pass # Client might have closed
+
+    def for_job(self, job):
+        return CommandContext(self.transport, self.client, self.send_line, job)
+
+    def progress(self, msg, plain=False):
+        # plain: legacy clients also get the bare line (UPDATE output)
+        if self.job:
+            self.job.report(msg, plain)
+        elif plain:
+            self.send(msg)
+
+    def cancelled(self):
+        return self.job is not None and self.job.cancel_event.is_set()
+
+    def sleep(self, seconds):
+        """Sleep that wakes up early on cancellation; returns False if the job was cancelled."""
+        if self.job:
+            return not self.job.cancel_event.wait(seconds)
+        time.sleep(seconds)
+        return True
+
+class CommandResult:
+    """Structured result of a command handler.
+
+    data is the JSON payload returned to HTTP callers and, unless text is set,
+    sent as the reply line over Bluetooth. text overrides the Bluetooth reply
+    for verbs whose wire answer is not JSON (CONFIG_SAVED, REBOOTING, ...).
+    """
+    __slots__ = ("ok", "data", "text")
+
+    def __init__(self, ok=True, data=None, text=None):
+        self.ok = ok
+        self.data = data
+        self.text = text
+
+    def line(self):
+        if self.text is not None:
+            return self.text
+        if self.data is not None:
+            return json.dumps(self.data)
+        return None
+
+class CommandStats:
+    __slots__ = ("calls", "errors", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def to_dict(self):
+        return {"calls": self.calls, "errors": self.errors,
+                "avg_ms": round(self.total / self.calls * 1000, 3) if self.calls else 0.0,
+                "max_ms": round(self.max * 1000, 3)}
+
+# Priority lanes, most urgent first. A verb's lane follows its group unless given explicitly.
+LANES = ("emergency", "motion", "config", "admin")
+LANE_RANK = {lane: rank for rank, lane in enumerate(LANES)}
+LANE_OF_GROUP = {"motion": "motion", "config": "config"}
+
+class CommandSpec:
+    """One registered verb: its handler, argument parser and dispatch hints."""
+    __slots__ = ("verb", "handler", "parse", "on_error", "group", "blocking", "lane", "stats")
+
+    def __init__(self, verb, handler, parse, on_error, group, blocking, lane):
+        self.verb = verb
+        self.handler = handler
+        self.parse = parse
+        self.on_error = on_error
+        self.group = group # "motion", "config", "wifi" or "admin"
+        self.blocking = blocking # Slow verb, run it off the event loop
+        self.lane = lane or LANE_OF_GROUP.get(group, "admin") # Scheduling priority, see CommandScheduler
+        self.stats = CommandStats()
+
+class CommandRouter:
+    """Verb -> handler table shared by the Bluetooth and HTTP front ends.
+
+    A text command is "VERB" or "VERB:<argument>". The verb is looked up in a
+    dict, the argument is parsed once by the verb's parse function and the
+    handler is called as handler(ctx, arg). Handlers return a CommandResult, a
+    dict (JSON data) or None. Every call is timed per verb; extra timing hooks
+    receive (verb, elapsed_seconds, result).
+    """
+
+    def __init__(self):
+        self.commands = {} # verb -> CommandSpec
+        self.hooks = []
+
+    def command(self, verb, parse=None, on_error=None, group="admin", blocking=False, lane=None):
+        def register(handler):
+            self.commands[verb] = CommandSpec(verb, handler, parse, on_error, group, blocking, lane)
+            return handler
+        return register
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def lookup(self, line):
+        return self.commands.get(line.partition(":")[0])
+
+    def dispatch(self, line, ctx):
+        """Parse a raw text command and run it."""
+        verb, _, raw = line.partition(":")
+        spec = self.commands.get(verb)
+        if spec is None:
+            log_msg(f"Unknown command: {line}", "system", WARNING)
+            return unknown_command(verb)
+        arg = None
+        if spec.parse:
+            try:
+                arg = spec.parse(raw)
+            except ValueError as e:
+                log_msg(f"Invalid argument for {verb}: {e}", "system", WARNING)
+                spec.stats.errors += 1
+                if spec.on_error:
+                    return spec.on_error(e)
+                return CommandResult(False, {"status": "error", "message": str(e)}, f"ERROR:{verb}:{e}")
+        return self.run(spec, arg, ctx)
+
+    def call(self, verb, arg, ctx):
+        """Run a verb with an already parsed argument (HTTP passes decoded JSON here)."""
+        spec = self.commands.get(verb)
+        if spec is None:
+            return unknown_command(verb)
+        return self.run(spec, arg, ctx)
+
+    def run(self, spec, arg, ctx):
+        if spec.lane == "motion":
+            ctx.driving = True
+        start = time.perf_counter()
+        try:
+            result = spec.handler(ctx, arg)
+            if result is None:
+                result = CommandResult()
+            elif not isinstance(result, CommandResult):
+                result = CommandResult(data=result)
+        except Exception as e:
+            log_msg(f"Command {spec.verb} failed: {e}", "system", ERROR)
+            if spec.on_error:
+                result = spec.on_error(e)
+            else:
+                result = CommandResult(False, {"status": "error", "message": str(e)}, f"ERROR:{spec.verb}:{e}")
+        elapsed = time.perf_counter() - start
+
+        stats = spec.stats
+        stats.calls += 1
+        stats.total += elapsed
+        if elapsed > stats.max:
+            stats.max = elapsed
+        if not result.ok:
+            stats.errors += 1
+        for hook in self.hooks:
+            try:
+                hook(spec.verb, elapsed, result)
+            except Exception as e:
+                log_msg(f"Command hook error: {e}", "system", ERROR)
+        return result
+
+def unknown_command(verb):
+    return CommandResult(False, {"status": "error", "message": f"Unknown command {verb}"},
+                         f"ERROR:UNKNOWN_COMMAND:{verb}")
+
+router = CommandRouter()
+
+# --- Background Jobs ---
+JOB_WORKERS = 2 # Slow commands running at the same time
+JOB_QUEUE_LIMIT = 16 # Queued + running jobs before new ones are refused
+JOB_HISTORY = 50 # Finished jobs kept for JOBS / GET /jobs
+JOB_HTTP_WAIT = 60 # Seconds an HTTP caller waits for a job result
+
+class Job:
+    __slots__ = ("id", "name", "fn", "ctx", "on_done", "state", "progress", "result",
+                 "created", "started", "finished", "cancel_event", "future")
+
+    def __init__(self, job_id, name, fn, ctx, on_done):
+        self.id = job_id
+        self.name = name
+        self.fn = fn
+        self.ctx = ctx # Connection that submitted the job (None for internal jobs)
+        self.on_done = on_done
+        self.state = "queued" # queued -> running -> done / failed / cancelled
+        self.progress = None
+        self.result = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self.future = None
+
+    def report(self, msg, plain=False):
+        self.progress = msg
+        if self.ctx is None:
+            return
+        if self.ctx.job_events:
+            self.ctx.send(f"JOB:{self.id}:progress:{msg}", droppable=True)
+        elif plain:
+            self.ctx.send(msg, droppable=True)
+
+    def to_dict(self):
+        result = self.result
+        if isinstance(result, CommandResult):
+            result = result.data if result.data is not None else result.text
+        return {"id": self.id, "name": self.name, "state": self.state, "progress": self.progress,
+                "result": result, "created": self.created, "started": self.started, "finished": self.finished}
+
+class JobManager:
+    """Bounded worker pool for slow commands (nmcli, deploy, GPIO scans).
+
+    submit() returns at once with a Job; the function runs on one of a fixed
+    number of worker threads as fn(job) and its return value becomes
+    job.result. Queued jobs are started by lane priority (config before
+    admin), FIFO within a lane. job.future completes when the job finishes.
+    Jobs are cancelled cooperatively through job.cancel_event.
+    """
+
+    def __init__(self, workers=JOB_WORKERS):
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.queue = [] # heap of (lane rank, job id, job)
+        self.next_id = 1
+        self.active = 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"job-{i}", daemon=True).start()
+
+    def submit(self, name, fn, ctx=None, on_done=None, lane="admin"):
+        with self.lock:
+            if self.active >= JOB_QUEUE_LIMIT:
+                return None
+            job = Job(self.next_id, name, fn, ctx, on_done)
+            job.future = Future()
+            self.next_id += 1
+            self.active += 1
+            self.jobs[job.id] = job
+            self._prune()
+            heapq.heappush(self.queue, (LANE_RANK.get(lane, len(LANES)), job.id, job))
+            self.ready.notify()
+        return job
+
+    def _worker(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                _, _, job = heapq.heappop(self.queue)
+            job.future.set_running_or_notify_cancel()
+            self._run(job)
+            job.future.set_result(job.result)
+
+    def _run(self, job):
+        try:
+            if job.cancel_event.is_set():
+                job.state = "cancelled"
+                return
+            job.state = "running"
+            job.started = time.time()
+            try:
+                job.result = job.fn(job)
+                if job.cancel_event.is_set():
+                    job.state = "cancelled"
+                elif isinstance(job.result, CommandResult) and not job.result.ok:
+                    job.state = "failed"
+                else:
+                    job.state = "done"
+            except Exception as e:
+                log_msg(f"Job {job.id} ({job.name}) failed: {e}", "jobs", ERROR)
+                job.result = CommandResult(False, {"status": "error", "message": str(e)}, f"ERROR:{job.name}:{e}")
+                job.state = "failed"
+        finally:
+            job.finished = time.time()
+            with self.lock:
+                self.active -= 1
+            if job.on_done:
+                try:
+                    job.on_done(job)
+                except Exception as e:
+                    log_msg(f"Job {job.id} callback error: {e}", "jobs", ERROR)
+
+    def _prune(self):
+        # Drop the oldest finished jobs beyond the history limit
+        excess = len(self.jobs) - JOB_HISTORY - self.active
+        if excess <= 0:
+            return
+        for job_id in [j.id for j in self.jobs.values() if j.finished][:excess]:
+            del self.jobs[job_id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_event.set()
+        return True
+
+job_manager = JobManager()
+
+def send_job_result(job):
+    ctx = job.ctx
+    if ctx is None:
+        return
+    line = job.result.line() if isinstance(job.result, CommandResult) else None
+    if ctx.job_events:
+        ctx.send(f"JOB:{job.id}:{job.state}" + (f":{line}" if line is not None else ""))
+    elif line is not None and job.state != "cancelled":
+        # Legacy clients just get the reply line they always got
+        ctx.send(line)
+
+def submit_command_job(ctx, verb, run):
+    """Run a slow verb as a job; run(job_ctx) must return a CommandResult."""
+    spec = router.commands.get(verb)
+    lane = spec.lane if spec else "admin"
+    job = job_manager.submit(verb, lambda job: run(ctx.for_job(job)), ctx, send_job_result, lane)
+    if job is None:
+        log_msg(f"Job queue full, {verb} refused", "jobs", WARNING)
+    elif ctx.job_events:
+        ctx.send(f"JOB:{job.id}:accepted:{verb}")
+    return job
+
+# --- Commands: Motion ---
+# Direction applied to motor 1 (move_left) and motor 2 (move_right); None leaves the motor alone
+MOVEMENTS = {
+    "FORWARD": ("FORWARD", "FORWARD"),
+    "BACKWARD": ("BACKWARD", "BACKWARD"),
+    "LEFT": ("BACKWARD", "FORWARD"),
+    "RIGHT": ("FORWARD", "BACKWARD"),
+    "STOP": ("STOP", "STOP"),
+    "M1_FORWARD": ("FORWARD", None),
+    "M1_BACKWARD": ("BACKWARD", None),
+    "M1_STOP": ("STOP", None),
+    "M2_FORWARD": (None, "FORWARD"),
+    "M2_BACKWARD": (None, "BACKWARD"),
+    "M2_STOP": (None, "STOP"),
+}
+
+def movement_handler(cmd, directions):
+    def handler(ctx, arg):
+        log_msg(f"Movement CMD: {cmd}", "control")
+        if cmd == "STOP":
+            # Emergency path: straight to the motors, not through the control loop
+            motor_controller.stop()
+            if ctx.transport != "MACRO":
+                macro_runner.abort(f"STOP via {ctx.transport}")
+        else:
+            motor_controller.set_directions(directions)
+    return handler
+
+for _cmd, _directions in MOVEMENTS.items():
+    _lane = "emergency" if _cmd == "STOP" else None
+    router.command(_cmd, group="motion", lane=_lane)(movement_handler(_cmd, _directions))
+
+def parse_motors(raw):
+    # "m1=0.6,m2=-0.4,move_right=0": motor id or role = signed output -1.0..1.0
+    pairs = []
+    for item in raw.split(","):
+        name, sep, value = item.partition("=")
+        if not sep or not name.strip():
+            raise ValueError(f"expected <motor>=<value>, got {item!r}")
+        pairs.append((name.strip(), float(value)))
+    return pairs
+
+def motors_error(message):
+    return CommandResult(False, {"status": "error", "message": message}, f"ERROR:MOTORS:{message}")
+
+@router.command("MOTORS", parse=parse_motors, group="motion")
+def cmd_motors(ctx, pairs):
+    """Set several motors at once; everything is validated first, then applied in one control tick.
+
+    Values are absolute outputs, not scaled by SPEED. A motor keeps its value
+    until the next command for it (a direction verb for drive motors, STOP for all).
+    """
+    if not pairs:
+        return motors_error("no motors given")
+    motor_keys = peripherals.motor_keys
+    outputs = {}
+    for name, value in pairs:
+        key = motor_keys.get(name)
+        if key is None:
+            return motors_error(f"unknown motor {name}")
+        if not -1.0 <= value <= 1.0:
+            return motors_error(f"{name}: {value} is outside -1..1")
+        if key in outputs:
+            return motors_error(f"motor {name} given twice")
+        outputs[key] = value
+    motor_controller.set_outputs(outputs)
+    log_msg(f"Motors: {', '.join(f'{name}={value:.2f}' for name, value in pairs)}", "control", DEBUG)
+
+DRIVE_LUT_STEPS = 100 # Lookup table entries per unit of stick travel (inputs are quantized to 0.01)
+DRIVE_DEFAULTS = {"mix": "arcade", "deadband": 0.05, "expo": 0.0, "turn_gain": 1.0, "max_output": 1.0}
+
+class DriveMixer:
+    """Turns a stick position (x = turn, y = throttle, -1.0..1.0) into left/right outputs.
+
+    Settings come from "drive" in config.json (see DRIVE_DEFAULTS):
+    deadband zeroes small deflections and rescales the rest, expo blends in
+    a cubic curve for finer control around the centre. Both are baked into
+    one lookup table per axis when the config changes, so a command costs
+    two table lookups and the mix. Mixes:
+        arcade     left = y + x, right = y - x, scaled back into range
+        curvature  the turn is proportional to the throttle (car-like),
+                   pivoting in place only when the throttle is zero
+    """
+
+    def __init__(self):
+        self.configure({})
+
+    def configure(self, config):
+        settings = dict(DRIVE_DEFAULTS)
+        try:
+            settings.update((key, value) for key, value in (config.get("drive") or {}).items() if key in DRIVE_DEFAULTS)
+            self.deadband = max(0.0, min(0.9, float(settings["deadband"])))
+            self.expo = max(0.0, min(1.0, float(settings["expo"])))
+            self.turn_gain = max(0.0, float(settings["turn_gain"]))
+            self.max_output = max(0.0, min(1.0, float(settings["max_output"])))
+        except (AttributeError, TypeError, ValueError) as e:
+            log_msg(f"Invalid drive settings, using defaults: {e}", "config", WARNING)
+            return self.configure({})
+        self.mix_name = settings["mix"] if settings["mix"] in ("arcade", "curvature") else "arcade"
+        self.throttle = tuple(self._shape(i / DRIVE_LUT_STEPS) for i in range(-DRIVE_LUT_STEPS, DRIVE_LUT_STEPS + 1))
+        self.turn = tuple(max(-1.0, min(1.0, v * self.turn_gain)) for v in self.throttle)
+
+    def _shape(self, v):
+        magnitude = abs(v)
+        if magnitude <= self.deadband:
+            return 0.0
+        magnitude = (magnitude - self.deadband) / (1.0 - self.deadband)
+        magnitude = (1.0 - self.expo) * magnitude + self.expo * magnitude ** 3
+        return magnitude if v > 0 else -magnitude
+
+    def mix(self, x, y):
+        x = self.turn[round((max(-1.0, min(1.0, x)) + 1.0) * DRIVE_LUT_STEPS)]
+        y = self.throttle[round((max(-1.0, min(1.0, y)) + 1.0) * DRIVE_LUT_STEPS)]
+        if self.mix_name == "curvature" and y:
+            left, right = y + abs(y) * x, y - abs(y) * x
+        else:
+            left, right = y + x, y - x
+        scale = max(1.0, abs(left), abs(right)) / self.max_output if self.max_output else 0.0
+        return (left / scale, right / scale) if scale else (0.0, 0.0)
+
+drive_mixer = DriveMixer()
+drive_mixer.configure(state.get("config"))
+
+def drive_vector(x, y):
+    # Stick position onto the two drive motors through the configured mixer
+    left, right = drive_mixer.mix(x, y)
+    motor_controller.set_outputs({1: left, 2: right})
+    log_msg(f"Drive vector: x={x:.2f} y={y:.2f} -> {left:.2f}/{right:.2f}", "control", DEBUG)
+
+def parse_drive(raw):
+    # "<x>,<y>", turn and throttle -1.0..1.0
+    x, sep, y = raw.partition(",")
+    if not sep:
+        raise ValueError("expected DRIVE:<x>,<y>")
+    x, y = float(x), float(y)
+    if not (-1.0 <= x <= 1.0 and -1.0 <= y <= 1.0):
+        raise ValueError("x and y must be in -1..1")
+    return x, y
+
+@router.command("DRIVE", parse=parse_drive, group="motion")
+def cmd_drive(ctx, vector):
+    """Joystick drive: one message instead of SPEED plus a direction. Outputs are not scaled by SPEED."""
+    drive_vector(*vector)
+
+# A setting rather than a movement: never dropped as late or superseded
+@router.command("SPEED", parse=int, group="motion", lane="config")
+def cmd_speed(ctx, val):
+    speed = map_speed(val)
+    state.update(speed=speed)
+    # Running motors pick up the new speed on the next control tick
+    motor_controller.request_apply()
+    log_msg(f"Speed set to {speed*100}%", "control", key="SPEED")
+
+# --- Commands: Configuration ---
+def config_save_error(e):
+    return CommandResult(False, {"status": "error", "message": str(e)}, f"ERROR_SAVING_CONFIG:{e}")
+
+@router.command("GET_CONFIG", group="config")
+def cmd_get_config(ctx, arg):
+    log_msg(f"Config requested via {ctx.transport} from {ctx.client}", "config")
+    config = state.get("config")
+    cfg_str = json.dumps(config)
+    log_msg(f"Sending config (len={len(cfg_str)})", "config")
+    return CommandResult(data=config, text=cfg_str)
+
+@router.command("SAVE_CONFIG", parse=json.loads, on_error=config_save_error, group="config", blocking=True)
+def cmd_save_config(ctx, new_config):
+    log_msg(f"Config save requested via {ctx.transport}", "config")
+    # Keep top-level settings (control_rate_hz, ...) that the editors don't send
+    new_config = {**state.get("config"), **new_config}
+    # Refuse a config that puts two devices on one pin; the registry is built without touching hardware
+    staged = PeripheralRegistry([DeviceRecord(dev) for dev in new_config.get("devices", []) if dev.get("id")])
+    if staged.conflicts:
+        raise ValueError(staged.conflicts[0])
+    old_drive = peripherals.drive
+    save_config(new_config)
+    state.update(config=new_config)
+    report = reconfigure_peripherals()
+    if peripherals.drive != old_drive:
+        # A drive motor was rebuilt, moved to other pins or given another role
+        motor_controller.stop()
+    motor_controller.configure(new_config)
+    scheduler.configure(new_config)
+    drive_mixer.configure(new_config)
+    log_msg(f"Config saved, peripherals reconfigured in {report['ms']} ms: created {report['created']}, "
+            f"closed {report['closed']}, kept {len(report['kept'])}", "config")
+    return CommandResult(data={"status": "success", "peripherals": report}, text="CONFIG_SAVED")
+
+
+def scan_hcsr04(pairs=((20, 21),)):
+    # Fire a trigger pulse on each candidate pair and check whether echo answers.
+    # Only known pairs are probed to avoid hanging on a full GPIO sweep.
+    from gpiozero import DigitalOutputDevice, DigitalInputDevice
+
+    results = []
+    for trig, echo in pairs:
+        try:
+            t = DigitalOutputDevice(trig)
+            e = DigitalInputDevice(echo, pull_up=False)
+
+            t.on()
+            time.sleep(0.00001)
+            t.off()
+
+            start = time.time()
+            timeout = start + 0.1
+            while e.value == 0 and time.time() < timeout: pass
+            pulse_start = time.time()
+            while e.value == 1 and time.time() < timeout: pass
+            pulse_end = time.time()
+
+            t.close()
+            e.close()
+
+            if pulse_end - pulse_start > 0:
+                results.append({"trigger": trig, "echo": echo})
+        except Exception:
+            pass
+    return results
+
+@router.command("SCAN_CONFIG", group="config", blocking=True)
+def cmd_scan_config(ctx, arg):
+    log_msg(f"Scan requested via {ctx.transport}", "config")
+    ctx.progress("Probing HC-SR04 pins")
+    return {"status": "success", "results": scan_hcsr04()}
+
+# --- Commands: Administration ---
+update_lock = threading.Lock()
+
+@router.command("UPDATE", blocking=True)
+def cmd_update(ctx, arg):
+    log_msg(f"Update requested via {ctx.transport}")
+    if not update_lock.acquire(blocking=False):
+        return CommandResult(False, text="Update already in progress")
+    try:
+        process = subprocess.Popen(["./deploy.sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, shell=False)
+        for line in process.stdout:
+            log_msg(line.strip())
+            ctx.progress(line.strip(), plain=True)
+            if ctx.cancelled():
+                process.terminate()
+                log_msg("Update cancelled")
+                break
+        process.wait()
+    except Exception as e:
+        err = f"ERROR: {e}"
+        log_msg(err)
+        ctx.progress(err, plain=True)
+    finally:
+        update_lock.release()
+    log_msg("DONE")
+    return CommandResult(text="DONE")
+
+@router.command("RESTART")
+def cmd_restart(ctx, arg):
+    log_msg(f"Restart requested via {ctx.transport}")
+    def do_reboot():
+        time.sleep(1) # Delay to allow the reply to reach the client
+        subprocess.run(["sudo", "reboot"])
+    threading.Thread(target=do_reboot, daemon=True).start()
+    return CommandResult(text="REBOOTING")
+
+@router.command("CMD_STATS")
+def cmd_stats(ctx, arg):
+    return {verb: spec.stats.to_dict() for verb, spec in router.commands.items() if spec.stats.calls}
+
+def parse_switch(raw):
+    if raw.upper() in ("ON", "1"):
+        return True
+    if raw.upper() in ("OFF", "0"):
+        return False
+    raise ValueError(f"expected ON or OFF, got {raw!r}")
+
+def parse_log_levels(raw):
+    # "control=DEBUG,bt=INFO"; empty means query only
+    levels = {}
+    for item in filter(None, raw.split(",")):
+        category, sep, name = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected category=LEVEL, got {item!r}")
+        levels[category.strip()] = name.strip()
+    return levels
+
+@router.command("LOG_LEVEL", parse=parse_log_levels)
+def cmd_log_level(ctx, levels):
+    if levels:
+        set_log_levels(levels)
+        log_msg(f"Log levels changed via {ctx.transport}: {levels}")
+    return log_level_names()
+
+@router.command("TRACE", parse=parse_switch)
+def cmd_trace(ctx, enabled):
+    # Per-command tracing: every received command and movement is logged, no aggregation
+    level = "DEBUG" if enabled else "INFO"
+    set_log_levels({"bt": level, "net": level, "control": level})
+    log_msg(f"Command tracing {'enabled' if enabled else 'disabled'} via {ctx.transport}")
+    return log_level_names()
+
+@router.command("LOG_STATS")
+def cmd_log_stats(ctx, arg):
+    return log_manager.stats()
+
+def log_query(params):
+    # since=<seq> | from=<ts>[,to=<ts>], plus limit=N
+    unknown = set(params) - {"since", "from", "to", "limit"}
+    if unknown:
+        raise ValueError(f"unknown parameter {sorted(unknown)[0]!r}")
+    query = {"limit": int(params.get("limit", 100))}
+    if "since" in params:
+        query["since"] = int(params["since"])
+    elif "from" in params or "to" in params:
+        query["ts_from"] = float(params["from"]) if "from" in params else None
+        query["ts_to"] = float(params["to"]) if "to" in params else None
+    else:
+        query["since"] = -1
+    return query
+
+def parse_log_query(raw):
+    # "since=120,limit=50" or "from=1700000000,to=1700003600"
+    params = {}
+    for item in filter(None, raw.split(",")):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected key=value, got {item!r}")
+        params[key.strip()] = value.strip()
+    return log_query(params)
+
+@router.command("LOGS", parse=parse_log_query, blocking=True)
+def cmd_logs(ctx, query):
+    records = log_store.query(**query)
+    next_since = records[-1]["seq"] if records else query.get("since")
+    return {"records": records, "next": next_since}
+
+def parse_version(raw):
+    return int(raw) if raw else 0
+
+@router.command("STATE", parse=parse_version)
+def cmd_state(ctx, since):
+    return state.delta(since)
+
+@router.command("UDP_STATS")
+def cmd_udp_stats(ctx, arg):
+    return {f"{addr[0]}:{addr[1]}": stream.to_dict()
+            for channel in udp_channels for addr, stream in list(channel.streams.items())}
+
+@router.command("SCHED_STATS")
+def cmd_sched_stats(ctx, arg):
+    return scheduler.snapshot()
+
+@router.command("JOBS")
+def cmd_jobs(ctx, arg):
+    return {"jobs": job_manager.list()}
+
+@router.command("JOB_STATUS", parse=int)
+def cmd_job_status(ctx, job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return CommandResult(False, {"status": "error", "message": f"No job {job_id}"}, f"ERROR:NO_JOB:{job_id}")
+    return job.to_dict()
+
+@router.command("JOB_CANCEL", parse=int)
+def cmd_job_cancel(ctx, job_id):
+    if not job_manager.cancel(job_id):
+        return CommandResult(False, {"status": "error", "message": f"Job {job_id} is not active"}, f"ERROR:NO_JOB:{job_id}")
+    log_msg(f"Job {job_id} cancel requested via {ctx.transport}", "jobs")
+    return {"status": "cancelling", "job": job_id}
+
+def parse_hello(raw):
+    # "" | "<version>" | "<version>,binary", optionally followed by ",<client ms>" for clock sync
+    version, *rest = raw.split(",")
+    client_ms = int(rest.pop()) if rest and rest[-1].strip().isdigit() else None
+    framing = rest[0].strip().lower() if rest else "text"
+    if framing not in ("text", "binary") or len(rest) > 1:
+        raise ValueError(f"unknown framing {framing!r}")
+    return (int(version) if version else PROTO_VERSION), framing, client_ms
+
+@router.command("HELLO", parse=parse_hello)
+def cmd_hello(ctx, hello):
+    """Capabilities handshake; "HELLO:1,binary" switches a stream client to binary frames after this reply."""
+    version, framing, client_ms = hello
+    if client_ms is not None and ctx.link:
+        ctx.link.clock_sample(client_ms)
+    binary_ok = ctx.transport in ("BT", "TCP", "UNIX")
+    if framing == "binary" and (not binary_ok or version < PROTO_VERSION):
+        return CommandResult(False, {"status": "error", "message": "binary framing not available"},
+                             "ERROR:HELLO:binary framing not available")
+    ctx.binary = framing == "binary"
+    return {
+        "hello": PROTO_VERSION,
+        "framing": framing,
+        "framings": ["text", "binary"] if binary_ok else ["text"],
+        "motors": [MOTOR_ROLES[motor_id] for motor_id in sorted(MOTOR_ROLES)],
+        "motor_ids": [record.id for record in peripherals.by_type.get("motor", ())],
+        "binary": {"motion": BIN_MOTION, "speed": BIN_SPEED, "stop": BIN_STOP, "text": BIN_TEXT,
+                   "scale": BIN_SCALE, "crc": "crc16-ccitt-ffff"},
+        "verbs": sorted(router.commands),
+        "heartbeat": dict(zip(("interval_ms", "deadman_ms"), (round(v * 1000) for v in heartbeat_settings()))),
+        "server_time": time.time(),
+    }
+
+@router.command("JOB_EVENTS", parse=parse_switch)
+def cmd_job_events(ctx, enabled):
+    # Per-connection: slow commands answer with JOB:<id>:accepted/progress/<state> frames
+    ctx.job_events = enabled
+    return CommandResult(text=f"JOB_EVENTS:{'ON' if enabled else 'OFF'}")
+
+def parse_pong(raw):
+    # "<seq>" or "<seq>:<echoed server ms>[:<client ms>]", only the sequence number matters
+    return int(raw.partition(":")[0])
+
+@router.command("PING", parse=str.strip)
+def cmd_ping(ctx, client_ms):
+    """Client-side RTT probe: "PING:<client ms>" is answered with "PONG:<client ms>:<server ms>"."""
+    if ctx.link and client_ms.isdigit():
+        ctx.link.clock_sample(int(client_ms))
+    return CommandResult(text=f"PONG:{client_ms}:{int(time.time() * 1000)}")
+
+@router.command("PONG", parse=parse_pong)
+def cmd_pong(ctx, seq):
+    # Answer to a server heartbeat PING, nothing is sent back
+    if ctx.link and ctx.link.pong(seq, time.monotonic()) is not None:
+        publish_links()
+
+@router.command("HEARTBEAT", parse=parse_switch)
+def cmd_heartbeat(ctx, enabled):
+    """Per-connection: server PINGs every heartbeat_interval_ms and stops the motors after deadman_timeout_ms of silence."""
+    if ctx.link is None:
+        return CommandResult(False, {"status": "error", "message": "heartbeat not available"},
+                             "ERROR:HEARTBEAT:not available")
+    ctx.link.enabled = enabled
+    ctx.link.last_rx = time.monotonic()
+    interval, deadman = heartbeat_settings()
+    return CommandResult(text=f"HEARTBEAT:{'ON' if enabled else 'OFF'}:{round(interval * 1000)}:{round(deadman * 1000)}")
+
+@router.command("LINK_STATS")
+def cmd_link_stats(ctx, arg):
+    return {link.name: {**link.to_dict(), "playout": dict(owner.playout.stats) if owner.playout else None}
+            for owner, link in list(link_monitors.items())}
+
+# --- Commands: Macros ---
+MACROS_FILE = "macros.json" # Macros uploaded with "persist": true, next to config.json
+MACRO_MAX_STEPS = 500
+MACRO_MAX_DELAY_MS = 60000
+MACRO_POLL = 0.02 # Seconds between abort checks while a macro waits for its next step
+MACRO_MIN_LAP_MS = 50 # Shortest pass through the steps of a repeating macro
+macros_lock = threading.Lock() # Uploads and deletes run as jobs, one macros.json write at a time
+
+def check_macro(macro):
+    """Validate and normalize an uploaded macro; raises ValueError.
+
+    {"name": "zigzag", "steps": [[0, "LEFT"], [200, "FORWARD"], [300, "STOP"]],
+     "repeat": 2, "abort_if": {"sensor": "s1", "below_cm": 20}, "persist": true}
+
+    Each step waits delay_ms after the previous one, then runs a motion verb.
+    repeat 0 loops until aborted; a repeating macro's delays must add up to
+    at least MACRO_MIN_LAP_MS so it never spins. abort_if (one condition or a list) is
+    checked continuously while the macro runs.
+    """
+    if not isinstance(macro, dict):
+        raise ValueError("macro must be a JSON object")
+    name = macro.get("name")
+    if not isinstance(name, str) or not name or not all(c.isalnum() or c in "_-" for c in name):
+        raise ValueError("name must be letters, digits, _ or -")
+    steps = macro.get("steps")
+    if not isinstance(steps, list) or not 0 < len(steps) <= MACRO_MAX_STEPS:
+        raise ValueError(f"steps must be a list of 1..{MACRO_MAX_STEPS} [delay_ms, command] pairs")
+    normalized = []
+    for i, step in enumerate(steps):
+        if not isinstance(step, (list, tuple)) or len(step) != 2 or not isinstance(step[1], str):
+            raise ValueError(f"step {i}: expected [delay_ms, command]")
+        delay, cmd = int(step[0]), step[1].strip()
+        if not 0 <= delay <= MACRO_MAX_DELAY_MS:
+            raise ValueError(f"step {i}: delay must be 0..{MACRO_MAX_DELAY_MS} ms")
+        spec = router.lookup(cmd)
+        if spec is None or spec.group != "motion":
+            raise ValueError(f"step {i}: {cmd!r} is not a motion command")
+        normalized.append([delay, cmd])
+    repeat = int(macro.get("repeat", 1))
+    if repeat < 0:
+        raise ValueError("repeat must be 0 (until aborted) or more")
+    if repeat != 1 and sum(delay for delay, _ in normalized) < MACRO_MIN_LAP_MS:
+        raise ValueError(f"a repeating macro needs step delays adding up to {MACRO_MIN_LAP_MS} ms or more")
+    conditions = macro.get("abort_if") or []
+    if isinstance(conditions, dict):
+        conditions = [conditions]
+    for cond in conditions:
+        if not isinstance(cond, dict) or not isinstance(cond.get("sensor"), str) or float(cond.get("below_cm", 0)) <= 0:
+            raise ValueError("abort_if needs {\"sensor\": <id or role>, \"below_cm\": <distance>}")
+    return {"name": name, "steps": normalized, "repeat": repeat,
+            "abort_if": [{"sensor": c["sensor"], "below_cm": float(c["below_cm"])} for c in conditions],
+            "persist": bool(macro.get("persist"))}
+
+def parse_macro(raw):
+    try:
+        return check_macro(json.loads(raw))
+    except TypeError as e:
+        raise ValueError(str(e)) from e
+
+def load_macros():
+    if os.path.exists(MACROS_FILE):
+        try:
+            with open(MACROS_FILE, "r") as f:
+                return {name: check_macro(macro) for name, macro in json.load(f).items()}
+        except Exception as e:
+            log_msg(f"Error loading macros: {e}", "control", ERROR)
+    return {}
+
+def save_macros():
+    try:
+        with macros_lock, open(MACROS_FILE, "w") as f:
+            json.dump({name: macro for name, macro in list(macros.items()) if macro["persist"]}, f, indent=4)
+    except Exception as e:
+        log_msg(f"Error saving macros: {e}", "control", ERROR)
+
+class MacroRun:
+    __slots__ = ("macro", "ctx", "abort_event", "reason", "replaced")
+
+    def __init__(self, macro, ctx):
+        self.macro = macro
+        self.ctx = ctx
+        self.abort_event = threading.Event()
+        self.reason = None
+        self.replaced = False # Aborted for another macro, which owns the motors now
+
+class MacroRunner:
+    """Runs one macro at a time on its own thread, timed by the monotonic clock.
+
+    Every step is due at the run's start time plus the sum of the delays
+    before it, so the time a step takes never shifts the ones after it.
+    Waits are sliced to MACRO_POLL to check the abort_if conditions. Starting
+    a macro aborts the one running; so do STOP from any client, a client
+    disconnect and the dead-man timeout. An aborted macro stops the motors.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+
+    def start(self, macro, ctx):
+        run = MacroRun(macro, ctx)
+        with self.lock:
+            previous, self.current = self.current, run
+        if previous:
+            previous.replaced = True
+            previous.reason = "replaced by " + macro["name"]
+            previous.abort_event.set()
+        state.update(macro={"name": macro["name"], "state": "running", "reason": None})
+        threading.Thread(target=self._run, args=(run,), name="macro", daemon=True).start()
+
+    def abort(self, reason):
+        with self.lock:
+            run = self.current
+        if run is None or run.abort_event.is_set():
+            return False
+        run.reason = reason
+        run.abort_event.set()
+        return True
+
+    def _run(self, run):
+        macro = run.macro
+        step_ctx = CommandContext("MACRO", macro["name"])
+        log_msg(f"Macro {macro['name']} started ({len(macro['steps'])} steps, repeat {macro['repeat'] or 'forever'})", "control")
+        due = time.monotonic()
+        lap = 0
+        try:
+            while not run.abort_event.is_set() and (macro["repeat"] == 0 or lap < macro["repeat"]):
+                for delay, cmd in macro["steps"]:
+                    due += delay / 1000
+                    if not self._wait(run, due):
+                        break
+                    result = router.dispatch(cmd, step_ctx)
+                    if not result.ok:
+                        self._fail(run, f"{cmd} failed: {result.line()}")
+                        break
+                lap += 1
         except Exception as e:
-             print(f"Error accepting connection: {e}")
+            self._fail(run, str(e))
+        outcome = "aborted" if run.abort_event.is_set() else "done"
+        if outcome == "aborted" and not run.replaced:
+            motor_controller.stop()
+        with self.lock:
+            if self.current is run:
+                self.current = None
+                state.update(macro={"name": macro["name"], "state": outcome, "reason": run.reason})
+        log_msg(f"Macro {macro['name']} {outcome}" + (f": {run.reason}" if run.reason else ""), "control")
+        run.ctx.send(f"MACRO:{macro['name']}:{outcome}" + (f":{run.reason}" if run.reason else ""))
+
+    def _fail(self, run, reason):
+        run.reason = reason
+        run.abort_event.set()
+
+    def _wait(self, run, due):
+        # False when the run was aborted or an abort_if condition hit before the step's time
+        while True:
+            reason = self._obstacle(run.macro)
+            if reason:
+                self._fail(run, reason)
+                return False
+            remaining = due - time.monotonic()
+            if remaining <= 0:
+                return not run.abort_event.is_set()
+            if run.abort_event.wait(min(remaining, MACRO_POLL)):
+                return False
+
+    def _obstacle(self, macro):
+        for cond in macro["abort_if"]:
+            sensor = peripherals.get(cond["sensor"])
+            if sensor is None or not hasattr(sensor, "distance"):
+                return f"sensor {cond['sensor']} not available"
+            distance = sensor.distance * 100
+            if distance < cond["below_cm"]:
+                return f"obstacle at {distance:.0f} cm on {cond['sensor']}"
+        return None
+
+macros = load_macros()
+macro_runner = MacroRunner()
+
+@router.command("MACRO_UPLOAD", parse=parse_macro, group="macro", lane="config", blocking=True)
+def cmd_macro_upload(ctx, macro):
+    macros[macro["name"]] = macro
+    save_macros()
+    log_msg(f"Macro {macro['name']} uploaded via {ctx.transport} ({len(macro['steps'])} steps)", "control")
+    return CommandResult(data={"status": "success", "name": macro["name"], "steps": len(macro["steps"])},
+                         text=f"MACRO_SAVED:{macro['name']}")
+
+@router.command("MACRO_RUN", parse=str.strip, group="macro", lane="motion")
+def cmd_macro_run(ctx, name):
+    macro = macros.get(name)
+    if macro is None:
+        return CommandResult(False, {"status": "error", "message": f"Unknown macro {name}"}, f"ERROR:MACRO:unknown macro {name}")
+    macro_runner.start(macro, ctx)
+    return CommandResult(data={"status": "started", "name": name}, text=f"MACRO:{name}:started")
+
+@router.command("MACRO_ABORT", group="macro", lane="emergency")
+def cmd_macro_abort(ctx, arg):
+    aborted = macro_runner.abort(f"MACRO_ABORT via {ctx.transport}")
+    return CommandResult(data={"status": "aborted" if aborted else "idle"}, text="MACRO_ABORTED" if aborted else "MACRO_IDLE")
+
+@router.command("MACRO_DELETE", parse=str.strip, group="macro", lane="config", blocking=True)
+def cmd_macro_delete(ctx, name):
+    if macros.pop(name, None) is None:
+        return CommandResult(False, {"status": "error", "message": f"Unknown macro {name}"}, f"ERROR:MACRO:unknown macro {name}")
+    save_macros()
+    return CommandResult(data={"status": "success"}, text=f"MACRO_DELETED:{name}")
+
+@router.command("MACRO_LIST", group="macro")
+def cmd_macro_list(ctx, arg):
+    return {"macros": macros, "last": state.get("macro")}
+
+# --- Commands: WiFi ---
+
+@router.command("WIFI_SCAN", group="wifi", blocking=True)
+def cmd_wifi_scan(ctx, arg):
+    log_msg(f"WiFi scan requested via {ctx.transport}", "wifi")
+    try:
+        # Use nmcli to scan for WiFi networks
+        # First trigger a rescan
+        ctx.progress("Rescanning WiFi networks")
+        subprocess.run(["nmcli", "dev", "wifi", "rescan"], capture_output=True, timeout=5)
+        if not ctx.sleep(2):  # Wait for scan to complete
+            return CommandResult(False, {"error": "Cancelled", "networks": []})
+
+        ctx.progress("Listing WiFi networks")
+
+        result = subprocess.run(["nmcli", "-t", "-f", "SSID,SIGNAL,SECURITY", "dev", "wifi", "list"], 
+                              capture_output=True, text=True, timeout=10)
+        networks = []
+        seen_ssids = set()
+
+        log_msg(f"nmcli output:\n{result.stdout}", "wifi", DEBUG)
 
-    server_sock.close()
+        for line in result.stdout.strip().split("\n"):
+            if line:
+                parts = line.split(":")
+                if len(parts) >= 2:
+                    ssid = parts[0].strip()
+                    if not ssid or ssid in seen_ssids:
+                        continue
+                    seen_ssids.add(ssid)
+
+                    signal = int(parts[1]) if parts[1].isdigit() else -100
+                    # Security can have multiple values separated by spaces
+                    security = parts[2].strip() if len(parts) >= 3 and parts[2].strip() else "Open"
+
+                    # Convert signal percentage to dBm (approximate)
+                    signal_dbm = -100 + (signal // 2)
+                    networks.append({"ssid": ssid, "signal": signal_dbm, "security": security})
+
+        response = {"networks": networks}
+        log_msg(f"WiFi scan complete: {len(networks)} networks found", "wifi")
+        return response
+    except Exception as e:
+        log_msg(f"WiFi scan error: {e}", "wifi", ERROR)
+        return {"error": str(e), "networks": []}
+
+def wifi_connect_error(e):
+    return CommandResult(False, {"status": "failed", "error": str(e)})
+
+@router.command("WIFI_CONNECT", parse=json.loads, on_error=wifi_connect_error, group="wifi", blocking=True)
+def cmd_wifi_connect(ctx, wifi_config):
+    log_msg(f"WiFi connect requested via {ctx.transport}", "wifi")
+    try:
+        ssid = wifi_config.get("ssid")
+        password = wifi_config.get("password", "")
+
+        log_msg(f"Attempting to connect to: {ssid}", "wifi")
+        ctx.progress(f"Connecting to {ssid}")
+
+        # First, disconnect from any active WiFi connection
+        active_result = subprocess.run(["nmcli", "-t", "-f", "NAME,TYPE", "con", "show", "--active"],
+                                      capture_output=True, text=True, timeout=5)
+        for line in active_result.stdout.strip().split("\n"):
+            if line:
+                parts = line.split(":")
+                if len(parts) >= 2 and "wireless" in parts[1].lower():
+                    active_wifi = parts[0]
+                    if active_wifi != ssid:  # Don't disconnect if already connected to target
+                        log_msg(f"Disconnecting from current WiFi: {active_wifi}", "wifi")
+                        subprocess.run(["nmcli", "con", "down", active_wifi], 
+                                     capture_output=True, timeout=5)
+                    break
+
+        # Try to connect using nmcli
+        # For secured networks, we need to specify the key-mgmt
+        if password:
+            # Try WPA-PSK first (most common)
+            result = subprocess.run([
+                "nmcli", "dev", "wifi", "connect", ssid, 
+                "password", password
+            ], capture_output=True, text=True, timeout=20)
+
+            # If that fails, try creating a connection profile explicitly
+            if result.returncode != 0 and not ctx.cancelled():
+                log_msg(f"First attempt failed: {result.stderr}", "wifi", WARNING)
+                ctx.progress("Creating WPA-PSK connection profile")
+                # Delete any existing connection with same name
+                subprocess.run(["nmcli", "con", "delete", ssid], capture_output=True)
+
+                # Create new connection
+                result = subprocess.run([
+                    "nmcli", "con", "add", 
+                    "type", "wifi",
+                    "con-name", ssid,
+                    "ssid", ssid,
+                    "wifi-sec.key-mgmt", "wpa-psk",
+                    "wifi-sec.psk", password
+                ], capture_output=True, text=True, timeout=10)
+
+                if result.returncode == 0:
+                    # Activate the connection
+                    result = subprocess.run([
+                        "nmcli", "con", "up", ssid
+                    ], capture_output=True, text=True, timeout=15)
+        else:
+            # Open network
+            result = subprocess.run([
+                "nmcli", "dev", "wifi", "connect", ssid
+            ], capture_output=True, text=True, timeout=15)
+
+        if result.returncode == 0:
+            response = {"status": "connected", "ssid": ssid}
+            log_msg(f"Connected to WiFi: {ssid}", "wifi")
+        else:
+            error_msg = result.stderr.strip() if result.stderr else result.stdout.strip()
+            response = {"status": "failed", "error": error_msg}
+            log_msg(f"WiFi connection failed: {error_msg}", "wifi", ERROR)
+
+        return response
+    except Exception as e:
+        log_msg(f"WiFi connect error: {e}", "wifi", ERROR)
+        return {"status": "failed", "error": str(e)}
+
+@router.command("WIFI_STATUS", group="wifi", blocking=True)
+def cmd_wifi_status(ctx, arg):
+    log_msg(f"WiFi status requested via {ctx.transport}", "wifi")
+    try:
+        # Get current WiFi connection
+        result = subprocess.run(["nmcli", "-t", "-f", "ACTIVE,SSID,SIGNAL", "dev", "wifi"],
+                              capture_output=True, text=True, timeout=5)
+        connected = False
+        ssid = ""
+        signal = 0
+
+        for line in result.stdout.strip().split("\n"):
+            if line.startswith("yes:"):
+                parts = line.split(":")
+                if len(parts) >= 3:
+                    connected = True
+                    ssid = parts[1]
+                    signal = int(parts[2]) if parts[2].isdigit() else 0
+                    signal = -100 + (signal // 2)  # Convert to dBm
+                    break
+
+        response = {"connected": connected, "ssid": ssid, "signal": signal}
+        log_msg(f"WiFi status: {'Connected to ' + ssid if connected else 'Not connected'}", "wifi")
+        return response
+    except Exception as e:
+        log_msg(f"WiFi status error: {e}", "wifi", ERROR)
+        return {"connected": False, "error": str(e)}
+
+@router.command("WIFI_DISCONNECT", group="wifi", blocking=True)
+def cmd_wifi_disconnect(ctx, arg):
+    log_msg(f"WiFi disconnect requested via {ctx.transport}", "wifi")
+    try:
+        # First, find the active WiFi connection name
+        result = subprocess.run(["nmcli", "-t", "-f", "NAME,TYPE", "con", "show", "--active"],
+                              capture_output=True, text=True, timeout=5)
+
+        wifi_connection = None
+        for line in result.stdout.strip().split("\n"):
+            if line:
+                parts = line.split(":")
+                if len(parts) >= 2 and "wireless" in parts[1].lower():
+                    wifi_connection = parts[0]
+                    break
+
+        if wifi_connection:
+            # Disconnect the active WiFi connection
+            result = subprocess.run(["nmcli", "con", "down", wifi_connection],
+                                  capture_output=True, text=True, timeout=5)
+
+            if result.returncode == 0:
+                response = {"status": "disconnected"}
+                log_msg(f"Disconnected from WiFi: {wifi_connection}", "wifi")
+            else:
+                response = {"status": "failed", "error": result.stderr.strip()}
+                log_msg(f"WiFi disconnect failed: {result.stderr.strip()}", "wifi", ERROR)
+        else:
+            response = {"status": "disconnected", "message": "No active WiFi connection"}
+            log_msg("No active WiFi connection to disconnect", "wifi")
+
+        return response
+    except Exception as e:
+        log_msg(f"WiFi disconnect error: {e}", "wifi", ERROR)
+        return {"status": "failed", "error": str(e)}
+
+# --- Command Framing ---
+# Largest single command we accept (SAVE_CONFIG / WIFI_CONNECT carry JSON payloads)
+MAX_COMMAND_BYTES = 64 * 1024
+
+class LineFramer:
+    """Incremental newline framing for one stream connection.
+
+    Bytes from recv() are appended to a per-connection buffer and split on
+    b"\\n". Partial lines stay buffered until the rest arrives, so a burst of
+    commands in one chunk and a payload spread over many chunks both come out
+    as whole commands. A line longer than max_line is discarded up to its
+    terminating newline instead of growing the buffer without bound.
+    """
+
+    def __init__(self, max_line=MAX_COMMAND_BYTES):
+        self.max_line = max_line
+        self.buffer = bytearray()
+        self.scanned = 0 # Bytes of buffer already known to contain no newline
+        self.discarding = False
+        self.overflows = 0
+
+    def feed(self, data):
+        """Add received bytes and return the list of complete lines (without b"\\n")."""
+        self.buffer += data
+        lines = []
+        start = 0
+        pos = self.scanned
+        while True:
+            idx = self.buffer.find(b"\n", pos)
+            if idx < 0:
+                break
+            if self.discarding:
+                # Tail of an oversized line, drop it
+                self.discarding = False
+            elif idx - start > self.max_line:
+                self._overflow()
+            else:
+                lines.append(bytes(self.buffer[start:idx]))
+            start = pos = idx + 1
+
+        if start:
+            del self.buffer[:start]
+        if len(self.buffer) > self.max_line:
+            # No newline within the limit: drop what we have and skip to the next newline
+            if not self.discarding:
+                self._overflow()
+            self.buffer.clear()
+            self.discarding = True
+        self.scanned = len(self.buffer)
+        return lines
+
+    def _overflow(self):
+        self.overflows += 1
+        log_msg(f"Command exceeds {self.max_line} bytes, dropped", "bt", WARNING)
+
+# Binary framing, negotiated with HELLO:1,binary. Every frame is
+#   opcode u8 | seq u16 | body | crc u16   (little endian, CRC-16/CCITT over opcode..body)
+# MOTION: one int16 per motor in HELLO's "motors" order, -32767..32767 = full reverse..full forward
+# SPEED:  int16 0..32767 = 0..100 %
+# STOP:   empty body
+# TEXT:   u16 length + UTF-8 text command, for everything else (replies stay text lines)
+PROTO_VERSION = 1
+BIN_MOTION, BIN_SPEED, BIN_STOP, BIN_TEXT = 0x01, 0x02, 0x03, 0x10
+BIN_HEADER = struct.Struct("<BH")
+BIN_CRC = struct.Struct("<H")
+BIN_TEXT_LEN = struct.Struct("<H")
+BIN_SCALE = 32767
+
+class BinaryFramer:
+    """Incremental decoder for binary frames, same role as LineFramer.
+
+    Fixed-size frames are sliced without scanning. A frame with an unknown
+    opcode or a bad CRC costs one byte: the decoder skips it and tries to
+    resynchronize on the next one.
+    """
+
+    def __init__(self, motor_count):
+        self.sizes = {BIN_MOTION: 2 * motor_count, BIN_SPEED: 2, BIN_STOP: 0}
+        self.motion = struct.Struct(f"<{motor_count}h")
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        """Add received bytes and return complete frames as (opcode, seq, body) tuples."""
+        self.buffer += data
+        buf = self.buffer
+        frames = []
+        pos = 0
+        while len(buf) - pos >= BIN_HEADER.size:
+            opcode, seq = BIN_HEADER.unpack_from(buf, pos)
+            body_start = pos + BIN_HEADER.size
+            if opcode == BIN_TEXT:
+                if len(buf) - body_start < BIN_TEXT_LEN.size:
+                    break
+                size = BIN_TEXT_LEN.size + BIN_TEXT_LEN.unpack_from(buf, body_start)[0]
+                if size > MAX_COMMAND_BYTES:
+                    pos += 1
+                    self.errors += 1
+                    continue
+            elif opcode in self.sizes:
+                size = self.sizes[opcode]
+            else:
+                pos += 1
+                self.errors += 1
+                continue
+            end = body_start + size
+            if len(buf) < end + BIN_CRC.size:
+                break
+            if binascii.crc_hqx(buf[pos:end], 0xFFFF) != BIN_CRC.unpack_from(buf, end)[0]:
+                pos += 1
+                self.errors += 1
+                continue
+            frames.append((opcode, seq, bytes(buf[body_start:end])))
+            pos = end + BIN_CRC.size
+        if pos:
+            del buf[:pos]
+        return frames
+
+def encode_binary(opcode, seq, body=b""):
+    # Reference encoder for clients and tools
+    frame = BIN_HEADER.pack(opcode, seq & 0xFFFF) + body
+    return frame + BIN_CRC.pack(binascii.crc_hqx(frame, 0xFFFF))
+
+# --- Bluetooth Server ---
+RFCOMM_CHANNEL = 1
+RFCOMM_BACKLOG = 4
+bt_clients = {} # CommandContext -> resolved device name, one entry per connected client
+
+def update_bt_status():
+    # The dashboard shows the most recently connected client
+    if bt_clients:
+        ctx, name = next(reversed(bt_clients.items()))
+        state.update(bt_status="Connected", bt_client=ctx.client, bt_device=name, bt_clients=len(bt_clients))
+    else:
+        state.update(bt_status="Disconnected", bt_client=None, bt_device=None, bt_clients=0)
+
+# --- Link Monitor ---
+HEARTBEAT_INTERVAL_MS = 1000 # Server PING period on heartbeat connections, "heartbeat_interval_ms" in config.json
+DEADMAN_TIMEOUT_MS = 1500 # Silence after which a heartbeat client's motors are stopped, "deadman_timeout_ms"
+LINK_CHECK_INTERVAL = 0.05 # Seconds between heartbeat/dead-man checks of one connection
+LINK_SAMPLES = 64 # RTT samples kept for percentiles
+CLOCK_SAMPLES = 64 # Client timestamps kept for the clock offset estimate
+
+link_monitors = {} # CommandContext -> LinkMonitor of connected stream clients
+
+def heartbeat_settings():
+    # (interval, dead-man timeout) in seconds; a timeout of 0 disables the dead-man stop
+    config = state.get("config")
+    try:
+        interval = max(50.0, float(config.get("heartbeat_interval_ms", HEARTBEAT_INTERVAL_MS)))
+        deadman = max(0.0, float(config.get("deadman_timeout_ms", DEADMAN_TIMEOUT_MS)))
+    except (TypeError, ValueError):
+        interval, deadman = HEARTBEAT_INTERVAL_MS, DEADMAN_TIMEOUT_MS
+    return interval / 1000, deadman / 1000
+
+class LinkMonitor:
+    """Heartbeat bookkeeping of one connection: RTT, jitter, lost PINGs and the dead-man timer.
+
+    RTT is smoothed like TCP's SRTT (gain 1/8), jitter is the RFC 3550
+    estimator (mean RTT deviation between consecutive samples, gain 1/16).
+    Percentiles come from the last LINK_SAMPLES samples. Any received byte
+    counts as a sign of life for the dead-man timer, PONGs included.
+
+    Client send times from HELLO and PING feed the clock offset: the
+    smallest server-minus-client difference among the last CLOCK_SAMPLES,
+    i.e. the clock offset plus the fastest one-way delay seen.
+    """
+
+    def __init__(self, name, transport, client):
+        self.name = name
+        self.transport = transport
+        self.client = client
+        self.enabled = False
+        self.seq = 0
+        self.pending = {} # seq -> monotonic send time
+        self.last_ping = 0.0
+        self.last_rx = time.monotonic()
+        self.tripped = False
+        self.srtt = None
+        self.last_rtt = None
+        self.jitter = 0.0
+        self.samples = collections.deque(maxlen=LINK_SAMPLES)
+        self.transits = collections.deque(maxlen=CLOCK_SAMPLES) # server ms - client ms
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.deadman_trips = 0
+
+    def ping(self, now):
+        self.seq += 1
+        self.sent += 1
+        self.pending[self.seq] = self.last_ping = now
+        return self.seq
+
+    def pong(self, seq, now):
+        sent = self.pending.pop(seq, None)
+        if sent is None:
+            return None # Unknown or already written off as lost
+        rtt = now - sent
+        self.received += 1
+        self.samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += (rtt - self.srtt) / 8
+            self.jitter += (abs(rtt - self.last_rtt) - self.jitter) / 16
+        self.last_rtt = rtt
+        return rtt
+
+    def clock_sample(self, client_ms):
+        transit = time.time() * 1000 - client_ms
+        self.transits.append(transit)
+        return transit
+
+    def clock_offset(self):
+        return min(self.transits) if self.transits else None
+
+    def expire(self, now, timeout):
+        for seq, sent in list(self.pending.items()):
+            if now - sent > timeout:
+                del self.pending[seq]
+                self.lost += 1
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+    def to_dict(self):
+        ms = lambda value: None if value is None else round(value * 1000, 1)
+        answered = self.received + self.lost
+        return {
+            "transport": self.transport, "client": self.client, "heartbeat": self.enabled,
+            "rtt_ms": ms(self.srtt), "jitter_ms": ms(self.jitter),
+            "p50_ms": ms(self.percentile(0.5)), "p95_ms": ms(self.percentile(0.95)), "p99_ms": ms(self.percentile(0.99)),
+            "pings": self.sent, "pongs": self.received, "lost": self.lost,
+            "loss_pct": round(100 * self.lost / answered, 1) if answered else 0.0,
+            "idle_ms": ms(time.monotonic() - self.last_rx), "deadman_trips": self.deadman_trips,
+            "clock_offset_ms": None if not self.transits else round(self.clock_offset(), 1),
+        }
+
+def publish_links():
+    # Dashboard summary; rounded to whole milliseconds so unchanged links don't bump the state version
+    links = {}
+    for link in list(link_monitors.values()):
+        if link.enabled:
+            links[link.name] = {"transport": link.transport, "client": link.client,
+                                "rtt_ms": None if link.srtt is None else round(link.srtt * 1000),
+                                "jitter_ms": round(link.jitter * 1000), "lost": link.lost}
+    state.update(links=links)
+
+async def run_heartbeat(ctx, link):
+    """Sends heartbeat PINGs to one client and enforces its dead-man timeout."""
+    while True:
+        await asyncio.sleep(LINK_CHECK_INTERVAL)
+        if not link.enabled:
+            continue
+        interval, deadman = heartbeat_settings()
+        now = time.monotonic()
+        if now - link.last_ping >= interval:
+            ctx.send(f"PING:{link.ping(now)}:{int(time.time() * 1000)}")
+        lost = link.lost
+        link.expire(now, max(deadman, 2 * interval))
+        if link.lost != lost:
+            publish_links()
+        if deadman and not link.tripped and now - link.last_rx > deadman:
+            # Re-armed by the next byte from this client
+            link.tripped = True
+            if motor_controller.moving():
+                link.deadman_trips += 1
+                log_msg(f"{link.name}: nothing received for {(now - link.last_rx) * 1000:.0f} ms, stopping motors",
+                        "control", WARNING)
+                scheduler.emergency_stop(f"dead-man timeout on {link.name}")
+
+OUTBOX_SOFT_FRAMES = 64 # Queued frames beyond which droppable lines (job progress) are discarded
+OUTBOX_MAX_FRAMES = 512 # Queued frames beyond which the client is considered stuck and disconnected
+OUTBOX_SEND_TIMEOUT = 5.0 # Seconds a single send may wait for the peer before it is disconnected
+
+class Outbox:
+    """Outbound queue of one connection, drained by a single writer task.
+
+    send() may be called from the loop or from any worker thread, each call
+    queues one whole encoded frame so lines never interleave. The writer
+    joins everything queued into one write, so a burst of replies becomes a
+    single send, then waits for the transport to drain, at most
+    OUTBOX_SEND_TIMEOUT. The receive loop never waits on a slow peer: under
+    backpressure droppable lines are discarded first, and a peer that stops
+    reading altogether is disconnected.
+    """
+
+    def __init__(self, loop, writer, name, encode=lambda line: (line + "\n").encode()):
+        self.loop = loop
+        self.writer = writer
+        self.name = name
+        self.encode = encode
+        self.frames = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.sends = 0
+        self.dropped = 0
+        self.task = loop.create_task(self._drain())
+
+    def send(self, line, droppable=False):
+        data = self.encode(line)
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._enqueue(data, droppable)
+        else:
+            self.loop.call_soon_threadsafe(self._enqueue, data, droppable)
+
+    def _enqueue(self, data, droppable):
+        if self.closed:
+            return
+        if droppable and len(self.frames) >= OUTBOX_SOFT_FRAMES:
+            self.dropped += 1
+            return
+        if len(self.frames) >= OUTBOX_MAX_FRAMES:
+            log_msg(f"{self.name}: {len(self.frames)} replies not read, disconnecting", "net", WARNING)
+            self.close()
+            return
+        self.frames.append(data)
+        self.wakeup.set()
+
+    async def _drain(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                if not self.frames:
+                    continue
+                data = b"".join(self.frames)
+                self.frames.clear()
+                self.writer.write(data)
+                self.sends += 1
+                await asyncio.wait_for(self.writer.drain(), OUTBOX_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            log_msg(f"{self.name}: send stalled for {OUTBOX_SEND_TIMEOUT:.0f}s, disconnecting", "net", WARNING)
+            self.close()
+        except (ConnectionError, OSError):
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.task.cancel()
+        self.writer.close()
+        if self.dropped:
+            log_msg(f"{self.name}: {self.dropped} progress lines dropped under backpressure", "net")
+
+def run_command(cmd_str, ctx):
+    reply = router.dispatch(cmd_str, ctx).line()
+    if reply is not None:
+        ctx.send(reply)
+
+async def resolve_client_name(ctx):
+    # bluetoothctl can take seconds, keep it off the receive path
+    job = job_manager.submit("BT_NAME", lambda job: get_bt_device_name(ctx.client))
+    if job is None:
+        return
+    await asyncio.wrap_future(job.future)
+    if ctx in bt_clients:
+        bt_clients[ctx] = job.result
+        update_bt_status()
+
+# --- Command Scheduler ---
+MOTION_DEADLINE_MS = 250 # Timed commands this far past their client timestamp are dropped, "motion_deadline_ms"
+PLAYOUT_DELAY_MS = 80 # Jitter buffer depth for timestamped commands, "jitter_buffer_ms" in config.json
+PLAYOUT_MAX_PENDING = 64 # Timestamped commands one client may have waiting
+PLAYOUT_MAX_AHEAD = 5.0 # Seconds a timestamped command may be scheduled ahead
+
+class CommandBatch:
+    """Commands that arrived in one read: how many STOPs are still ahead."""
+    __slots__ = ("stops",)
+
+    def __init__(self, stops):
+        self.stops = stops
+
+class CommandScheduler:
+    """Runs client commands by priority lane instead of strictly in arrival order.
+
+    emergency (STOP, disconnects): applied at once from the event loop, never
+        queued. Motion commands that arrived in the same read ahead of a STOP
+        are dropped as superseded instead of moving the robot first.
+    motion: runs inline. A timed command (AT:, see PlayoutBuffer) carries its
+        send time and is dropped once more than motion_deadline_ms late, a
+        late steering command is worse than none. Plain lines carry no send
+        time, they run as soon as they are read.
+    config, admin: blocking verbs run as jobs, the job pool starts queued
+        config work before admin work. Neither ever delays the lanes above,
+        and neither is dropped: a late timed setting still runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {lane: {"run": 0, "expired": 0, "superseded": 0} for lane in LANES}
+        self.emergency_verbs = None # Encoded emergency lane verbs, filled on first use
+        self.deadline = MOTION_DEADLINE_MS / 1000
+        self.playout_delay = PLAYOUT_DELAY_MS / 1000
+
+    def configure(self, config):
+        try:
+            self.deadline = max(0.0, float(config.get("motion_deadline_ms", MOTION_DEADLINE_MS))) / 1000
+            self.playout_delay = max(0.0, float(config.get("jitter_buffer_ms", PLAYOUT_DELAY_MS))) / 1000
+        except (TypeError, ValueError):
+            self.deadline = MOTION_DEADLINE_MS / 1000
+            self.playout_delay = PLAYOUT_DELAY_MS / 1000
+
+    def batch(self, items):
+        if self.emergency_verbs is None:
+            self.emergency_verbs = {spec.verb.encode() for spec in router.commands.values() if spec.lane == "emergency"}
+        stops = 0
+        for item in items:
+            if isinstance(item, bytes):
+                stops += item.strip().partition(b":")[0] in self.emergency_verbs
+            else:
+                stops += item[0] == BIN_STOP
+        return CommandBatch(stops)
+
+    def _count(self, lane, outcome):
+        with self.lock:
+            self.stats[lane][outcome] += 1
+
+    def admit(self, lane, batch, what):
+        """Account for one command about to run; False means drop it."""
+        if lane == "emergency":
+            if batch is not None and batch.stops:
+                batch.stops -= 1
+        elif lane == "motion" and batch is not None:
+            if batch.stops:
+                self._count(lane, "superseded")
+                log_msg(f"{what} superseded by a queued STOP", "control", DEBUG)
+                return False
+        self._count(lane, "run")
+        return True
+
+    def expire(self, cmd_str, lateness):
+        """Count a timed motion command that arrived more than the deadline past its send time."""
+        self._count("motion", "expired")
+        log_msg(f"{cmd_str} dropped, {lateness * 1000:.0f} ms past its deadline", "control", WARNING)
+
+    def submit(self, cmd_str, ctx, category, batch=None, timed=False):
+        log_msg(f"Received from {ctx.transport}: {cmd_str}", category, DEBUG)
+        if cmd_str.startswith("AT:") and ctx.playout:
+            _, client_ms, inner = (cmd_str + "::").split(":", 2)
+            inner = inner.rstrip(":").strip()
+            if not client_ms.isdigit() or not inner:
+                ctx.send("ERROR:AT:expected AT:<client ms>:<command>")
+            else:
+                ctx.playout.add(int(client_ms), inner)
+            return
+        spec = router.lookup(cmd_str)
+        if spec is None:
+            run_command(cmd_str, ctx)
+            return
+        # timed: it came out of the playout buffer, a timed STOP keeps what is queued after it
+        if spec.lane == "emergency" and ctx.playout and not timed:
+            ctx.playout.flush()
+        if not self.admit(spec.lane, batch, spec.verb):
+            return
+        if spec.blocking:
+            # Slow verbs become jobs so STOP from this client is never stuck behind them
+            job = submit_command_job(ctx, spec.verb, lambda job_ctx: router.dispatch(cmd_str, job_ctx))
+            if job is None:
+                ctx.send("ERROR:JOBS_BUSY")
+        else:
+            run_command(cmd_str, ctx)
+
+    def emergency_stop(self, reason):
+        self._count("emergency", "run")
+        motor_controller.stop()
+        macro_runner.abort(reason)
+        log_msg(f"Motors stopped: {reason}", "control", DEBUG)
+
+    def snapshot(self):
+        with self.lock:
+            lanes = {lane: dict(counts) for lane, counts in self.stats.items()}
+        return {"motion_deadline_ms": round(self.deadline * 1000), "lanes": lanes,
+                "jobs_queued": len(job_manager.queue)}
+
+scheduler = CommandScheduler()
+scheduler.configure(state.get("config"))
+
+class PlayoutBuffer:
+    """Jitter buffer of one client: runs AT:<client ms>:<command> lines at their intended times.
+
+    The client time is mapped to server time with the connection's clock
+    offset (see LinkMonitor.clock_offset; without HELLO/PING samples the
+    first timestamped command sets it) and the command is due playout_delay
+    after that, so a burst that Bluetooth delivered clumped is spread back
+    out. A command arriving after its slot runs at once (late), or is dropped
+    when it is a motion command more than motion_deadline_ms late. Other
+    lanes are never dropped: a timed STOP or setting that cannot be queued
+    runs at once. Only an untimed STOP discards whatever is still waiting.
+    """
+
+    def __init__(self, loop, ctx, category):
+        self.loop = loop
+        self.ctx = ctx
+        self.category = category
+        self.queue = [] # heap of (due monotonic time, arrival order, command)
+        self.order = 0
+        self.timer = None
+        self.stats = {"scheduled": 0, "late": 0, "dropped": 0, "flushed": 0}
+
+    def add(self, client_ms, cmd_str):
+        link = self.ctx.link
+        if link.clock_offset() is None:
+            link.clock_sample(client_ms)
+        due_ms = client_ms + link.clock_offset() + scheduler.playout_delay * 1000
+        lateness = (time.time() * 1000 - due_ms) / 1000
+        spec = router.lookup(cmd_str)
+        # Only motion is ever dropped; STOP or a setting late, too far ahead or over the limit runs now instead
+        droppable = spec is not None and spec.lane == "motion"
+        overflow = -lateness > PLAYOUT_MAX_AHEAD or len(self.queue) >= PLAYOUT_MAX_PENDING
+        if droppable and lateness > scheduler.deadline:
+            self.stats["dropped"] += 1
+            scheduler.expire(cmd_str, lateness)
+            return
+        if droppable and overflow:
+            self.stats["dropped"] += 1
+            log_msg(f"{cmd_str} @{client_ms} dropped, {lateness * 1000:.0f} ms from its slot", "control", WARNING)
+            return
+        if lateness > 0 or overflow:
+            # Its slot has passed; anything still queued is due later, so order is kept
+            self.stats["late"] += 1
+            scheduler.submit(cmd_str, self.ctx, self.category, timed=True)
+            return
+        self.stats["scheduled"] += 1
+        self.order += 1
+        heapq.heappush(self.queue, (time.monotonic() - lateness, self.order, cmd_str))
+        self._arm()
+
+    def _arm(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.queue:
+            self.timer = self.loop.call_later(max(0.0, self.queue[0][0] - time.monotonic()), self._fire)
+
+    def _fire(self):
+        self.timer = None
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, cmd_str = heapq.heappop(self.queue)
+            scheduler.submit(cmd_str, self.ctx, self.category, timed=True)
+        self._arm()
+
+    def flush(self):
+        self.stats["flushed"] += len(self.queue)
+        self.queue.clear()
+        self._arm()
+
+def run_binary(frame, ctx, framer, batch=None):
+    opcode, seq, body = frame
+    if opcode == BIN_MOTION:
+        if not scheduler.admit("motion", batch, f"Binary MOTION #{seq}"):
+            return
+        values = framer.motion.unpack(body)
+        ctx.driving = True
+        motor_controller.set_outputs({motor_id: max(-1.0, min(1.0, value / BIN_SCALE))
+                                      for motor_id, value in zip(MOTOR_ROLES, values)})
+        log_msg(f"Binary MOTION #{seq}: {values}", "control", DEBUG)
+    elif opcode == BIN_SPEED:
+        scheduler.admit("config", batch, "Binary SPEED")
+        state.update(speed=max(0.0, min(1.0, struct.unpack("<h", body)[0] / BIN_SCALE)))
+        motor_controller.request_apply()
+        log_msg(f"Binary SPEED #{seq}: {state.get('speed'):.2f}", "control", DEBUG)
+    elif opcode == BIN_STOP:
+        if ctx.playout:
+            ctx.playout.flush()
+        scheduler.admit("emergency", batch, "STOP")
+        run_command("STOP", ctx)
+    elif opcode == BIN_TEXT:
+        try:
+            cmd_str = body[BIN_TEXT_LEN.size:].decode("utf-8").strip()
+        except UnicodeDecodeError:
+            ctx.send(f"ERROR:FRAME:{seq}")
+            return
+        if cmd_str:
+            scheduler.submit(cmd_str, ctx, "bt" if ctx.transport == "BT" else "net", batch)
+
+async def handle_client(reader, writer, transport="BT"):
+    """One coroutine per connected client: read, frame and dispatch its commands.
+
+    The protocol is the same on every stream transport, only Bluetooth
+    clients show up in the dashboard's connection status.
+    """
+    loop = asyncio.get_running_loop()
+    peer = writer.get_extra_info("peername")
+    addr = peer[0] if isinstance(peer, tuple) else (peer or "local")
+    category = "bt" if transport == "BT" else "net"
+    log_msg(f"Accepted {transport} connection from {peer or addr}", category)
+
+    sock = writer.get_extra_info("socket")
+    if transport == "TCP" and sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    outbox = Outbox(loop, writer, f"{transport} {addr}")
+    ctx = CommandContext(transport, addr, outbox.send)
+    port = f":{peer[1]}" if isinstance(peer, tuple) else ""
+    ctx.link = link_monitors[ctx] = LinkMonitor(f"{transport} {addr}{port}", transport, addr)
+    heartbeat_task = asyncio.create_task(run_heartbeat(ctx, ctx.link))
+    ctx.playout = PlayoutBuffer(loop, ctx, category)
+    name_task = None
+    if transport == "BT":
+        bt_clients[ctx] = None
+        update_bt_status()
+        name_task = asyncio.create_task(resolve_client_name(ctx))
+
+    framer = LineFramer()
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            ctx.link.last_rx = time.monotonic()
+            ctx.link.tripped = False
+
+            # One read may carry several commands or only part of one
+            items = collections.deque(framer.feed(data))
+            batch = scheduler.batch(items)
+            while items:
+                item = items.popleft()
+                if not isinstance(item, bytes):
+                    run_binary(item, ctx, framer, batch)
+                    continue
+                try:
+                    cmd_str = item.decode("utf-8").strip()
+                except UnicodeDecodeError:
+                    log_msg("Decode error", category, WARNING)
+                    continue
+                if cmd_str:
+                    scheduler.submit(cmd_str, ctx, category, batch)
+                if ctx.binary and isinstance(framer, LineFramer):
+                    # HELLO switched this client to binary frames, whatever followed it is binary
+                    rest = b"".join(line + b"\n" for line in items) + bytes(framer.buffer)
+                    framer = BinaryFramer(len(MOTOR_ROLES))
+                    items = collections.deque(framer.feed(rest))
+                    batch.stops = scheduler.batch(items).stops
+    except (ConnectionError, OSError):
+        log_msg("Connection disconnected", category)
+    finally:
+        heartbeat_task.cancel()
+        ctx.playout.flush()
+        link_monitors.pop(ctx, None)
+        if ctx.link.enabled:
+            publish_links()
+        if name_task:
+            name_task.cancel()
+            bt_clients.pop(ctx, None)
+            update_bt_status()
+        outbox.close()
+        log_msg(f"Client {addr} closed", category)
+        # Stop motors on disconnect for safety, unless this client never drove (monitoring scripts)
+        if ctx.driving:
+            scheduler.emergency_stop(f"{transport} client {addr} disconnected")
+
+# --- Transports ---
+# Listener specs: "rfcomm[:channel]", "tcp:[host:]port", "unix:/path/to.sock",
+# "udp:[host:]port" (motion-only real-time channel, see UdpControlChannel).
+# Taken from "listen" in config.json, --listen on the command line overrides it.
+DEFAULT_LISTEN = ("rfcomm",)
+
+def parse_listen(spec):
+    """Split a listener spec into (kind, address); raises ValueError."""
+    kind, _, rest = spec.partition(":")
+    kind = kind.lower()
+    if kind == "rfcomm":
+        return kind, int(rest) if rest else RFCOMM_CHANNEL
+    if kind in ("tcp", "udp"):
+        host, _, port = rest.rpartition(":")
+        return kind, (host or "0.0.0.0", int(port))
+    if kind == "unix":
+        if not rest:
+            raise ValueError("unix listener needs a path")
+        return kind, rest
+    raise ValueError(f"unknown transport {kind!r}")
+
+async def open_rfcomm(channel):
+    if not hasattr(socket, "AF_BLUETOOTH"):
+        print("Error: this Python has no Bluetooth socket support, use a tcp: or unix: listener")
+        return None
+    # Use standard socket instead of PyBluez
+    server_sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+
+    # Bind to any adapter on the channel
+    try:
+        server_sock.bind((socket.BDADDR_ANY, channel))
+    except PermissionError:
+        server_sock.close()
+        print("Error: Permission denied. Try running with sudo.")
+        return None
+    except OSError as e:
+        server_sock.close()
+        print(f"Error binding to port: {e}")
+        return None
+
+    server_sock.listen(RFCOMM_BACKLOG)
+    server_sock.setblocking(False)
+    server = await asyncio.start_server(handle_client, sock=server_sock)
+
+    print(f"Waiting for connections on RFCOMM channel {channel}...")
+    print(f"Ensure your Android app is connecting to this device's MAC address on UUID/Channel {channel}")
+    return server
+
+async def open_listener(spec):
+    """Start one command listener; returns the asyncio server or None if it could not start."""
+    try:
+        kind, address = parse_listen(spec)
+    except ValueError as e:
+        print(f"Ignoring listener {spec!r}: {e}")
+        return None
+    try:
+        if kind == "rfcomm":
+            return await open_rfcomm(address)
+        if kind == "tcp":
+            server = await asyncio.start_server(lambda r, w: handle_client(r, w, "TCP"), *address)
+        elif kind == "udp":
+            server = UdpControlChannel()
+            await asyncio.get_running_loop().create_datagram_endpoint(lambda: server, local_addr=address)
+        else:
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    print(f"Error starting {spec} listener: {address} exists and is not a socket")
+                    return None
+                os.unlink(address) # Stale socket from a previous run
+            server = await asyncio.start_unix_server(lambda r, w: handle_client(r, w, "UNIX"), address)
+    except OSError as e:
+        print(f"Error starting {spec} listener: {e}")
+        return None
+    print(f"Listening for commands on {spec}")
+    return server
+
+# --- UDP Control Channel ---
+UDP_DEADLINE_MS = 500 # Silence after which a UDP driver's motors are stopped, "udp_deadline_ms" in config.json
+UDP_MAX_LATE_MS = 150 # Packets delayed more than this beyond the fastest seen are dropped, "udp_max_late_ms"
+UDP_RESTART_GAP = 1000 # A sequence number this far behind means the client restarted its counter
+UDP_STREAM_IDLE = 60 # Seconds after which a silent sender's stats are forgotten
+
+def udp_settings():
+    # (max late ms, deadline in seconds) from config.json, defaults for missing or invalid values
+    config = state.get("config")
+    try:
+        max_late = max(0.0, float(config.get("udp_max_late_ms", UDP_MAX_LATE_MS)))
+        deadline = max(0.0, float(config.get("udp_deadline_ms", UDP_DEADLINE_MS)))
+    except (TypeError, ValueError):
+        max_late, deadline = UDP_MAX_LATE_MS, UDP_DEADLINE_MS
+    return max_late, deadline / 1000
+
+class UdpStream:
+    """Per-sender sequencing and link statistics."""
+
+    def __init__(self):
+        self.last_seq = None
+        self.last_arrival = 0.0 # monotonic
+        self.min_transit = None # Smallest arrival - client timestamp seen, ms (clock offset + best delay)
+        self.prev_transit = None
+        self.jitter = 0.0 # RFC 3550 interarrival jitter estimate, ms
+        self.received = 0
+        self.applied = 0
+        self.stale = 0 # Reordered or duplicated
+        self.late = 0
+        self.lost = 0 # Sequence gaps never filled
+        self.driving = False # Last applied command left the motors running
+
+    def to_dict(self):
+        return {"last_seq": self.last_seq, "received": self.received, "applied": self.applied,
+                "stale": self.stale, "late": self.late, "lost": self.lost,
+                "jitter_ms": round(self.jitter, 2), "idle_s": round(time.monotonic() - self.last_arrival, 2)}
+
+class UdpControlChannel(asyncio.DatagramProtocol):
+    """Motion and SPEED over UDP, newest-wins, for teleoperation over WiFi.
+
+    Each datagram is "<seq>:<client ms timestamp>:<command>", for example
+    "1042:1718000000123:FORWARD". Only commands of the "motion" group are
+    accepted, admin verbs stay on the reliable transports. A datagram whose
+    sequence number is not newer than the last applied one is stale and
+    dropped; one that took more than udp_max_late_ms longer than the
+    fastest seen is late and dropped too. A sender that goes silent for
+    udp_deadline_ms while driving gets the motors stopped. Errors are
+    answered with a datagram, accepted commands are not.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.streams = {} # addr -> UdpStream
+
+    def connection_made(self, transport):
+        self.transport = transport
+        udp_channels.append(self)
+
+    def datagram_received(self, data, addr):
+        now = time.monotonic()
+        stream = self.streams.get(addr)
+        if stream is None:
+            stream = self.streams[addr] = UdpStream()
+            log_msg(f"UDP control stream from {addr[0]}:{addr[1]}", "net")
+        stream.received += 1
+        stream.last_arrival = now
+        try:
+            seq, ts, cmd_str = data.decode("utf-8").strip().split(":", 2)
+            seq, ts = int(seq), int(ts)
+        except ValueError:
+            self.transport.sendto(b"ERROR:UDP_FORMAT\n", addr)
+            return
+
+        if stream.last_seq is not None and seq <= stream.last_seq:
+            if stream.last_seq - seq < UDP_RESTART_GAP:
+                stream.stale += 1
+                return
+            stream.min_transit = stream.prev_transit = None # Client restarted its counter
+        elif stream.last_seq is not None:
+            stream.lost += seq - stream.last_seq - 1
+
+        transit = time.time() * 1000 - ts
+        if stream.min_transit is None or transit < stream.min_transit:
+            stream.min_transit = transit
+        if stream.prev_transit is not None:
+            stream.jitter += (abs(transit - stream.prev_transit) - stream.jitter) / 16
+        stream.prev_transit = transit
+        stream.last_seq = seq
+        if transit - stream.min_transit > udp_settings()[0]:
+            stream.late += 1
+            return
+
+        spec = router.lookup(cmd_str)
+        if spec is None or spec.group != "motion":
+            verb = cmd_str.partition(":")[0]
+            self.transport.sendto(f"ERROR:UDP_MOTION_ONLY:{verb}\n".encode(), addr)
+            return
+        result = router.dispatch(cmd_str, CommandContext("UDP", addr[0]))
+        if not result.ok:
+            self.transport.sendto((result.line() + "\n").encode(), addr)
+            return
+        stream.applied += 1
+        if spec.verb != "SPEED":
+            stream.driving = spec.verb != "STOP"
+
+    async def serve_forever(self):
+        # Deadline watchdog, also forgets senders that went away
+        while True:
+            await asyncio.sleep(0.05)
+            now = time.monotonic()
+            deadline = udp_settings()[1]
+            for addr, stream in list(self.streams.items()):
+                idle = now - stream.last_arrival
+                if stream.driving and idle > deadline:
+                    stream.driving = False
+                    motor_controller.stop()
+                    log_msg(f"UDP stream {addr[0]}:{addr[1]} silent for {idle * 1000:.0f} ms, motors stopped", "net", WARNING)
+                elif idle > UDP_STREAM_IDLE:
+                    del self.streams[addr]
+
+udp_channels = []
+
+async def serve_transports(specs):
+    servers = [server for server in await asyncio.gather(*(open_listener(spec) for spec in specs)) if server]
+    if not servers:
+        return
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+# --- WebSocket Channel ---
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+WS_BAD_REQUEST = b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+WS_FORBIDDEN = b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+def ws_frame(opcode, payload):
+    # Server frames are never masked or fragmented
+    length = len(payload)
+    if length < 126:
+        header = bytes((0x80 | opcode, length))
+    elif length < 65536:
+        header = bytes((0x80 | opcode, 126)) + length.to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, 127)) + length.to_bytes(8, "big")
+    return header + payload
+
+def ws_text(line):
+    return ws_frame(WS_TEXT, line.encode("utf-8"))
+
+async def ws_read_message(reader):
+    """Return (opcode, payload) of the next message, reassembling fragments.
+
+    Control frames (ping/pong/close) are returned as soon as they arrive,
+    they may be interleaved with the fragments of a data message.
+    """
+    message = bytearray()
+    message_opcode = None
+    while True:
+        b0, b1 = await reader.readexactly(2)
+        opcode = b0 & 0x0F
+        length = b1 & 0x7F
+        if length == 126:
+            length = int.from_bytes(await reader.readexactly(2), "big")
+        elif length == 127:
+            length = int.from_bytes(await reader.readexactly(8), "big")
+        if not b1 & 0x80:
+            raise ValueError("unmasked client frame")
+        if len(message) + length > MAX_COMMAND_BYTES:
+            raise ValueError("message too large")
+        mask = await reader.readexactly(4)
+        payload = await reader.readexactly(length)
+        if length:
+            # Unmask the whole payload as one big integer XOR instead of byte by byte
+            key = int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+            payload = (int.from_bytes(payload, "big") ^ key).to_bytes(length, "big")
+        if opcode >= WS_CLOSE:
+            return opcode, payload
+        if opcode:
+            message_opcode = opcode
+        message += payload
+        if b0 & 0x80:
+            return message_opcode, bytes(message)
+
+def ws_ack(msg_id, ok, **fields):
+    # Every message is acknowledged with the server time it was handled at
+    return json.dumps({"ack": msg_id, "ok": ok, "ts": time.time(), **fields})
+
+def ws_handle_message(text, ctx):
+    """Run one WebSocket message and return its ack.
+
+    A message is either a plain protocol line ("FORWARD", "SPEED:200", ...)
+    or JSON: {"id": 7, "cmd": "FORWARD"} or {"id": 8, "drive": [x, y]} with
+    x (turn) and y (throttle) in -1.0..1.0.
+    """
+    msg_id = None
+    if text.startswith("{"):
+        try:
+            msg = json.loads(text)
+        except ValueError as e:
+            return ws_ack(None, False, error=f"bad json: {e}")
+        msg_id = msg.get("id")
+        if "drive" in msg:
+            try:
+                x, y = (float(v) for v in msg["drive"])
+            except (TypeError, ValueError):
+                x = y = math.nan
+            if not (math.isfinite(x) and math.isfinite(y)):
+                # json.loads accepts NaN and Infinity, which clamping would turn into full power
+                return ws_ack(msg_id, False, error="drive expects [x, y]")
+            x, y = max(-1.0, min(1.0, x)), max(-1.0, min(1.0, y))
+            scheduler.admit("motion", None, "drive")
+            ctx.driving = True
+            drive_vector(x, y)
+            return ws_ack(msg_id, True)
+        text = str(msg.get("cmd", ""))
+    cmd_str = text.strip()
+    if not cmd_str:
+        return ws_ack(msg_id, False, error="empty command")
+    spec = router.lookup(cmd_str)
+    if spec:
+        # One message per frame, so there is no batch to expire or supersede
+        scheduler.admit(spec.lane, None, spec.verb)
+    if spec and spec.blocking:
+        # Job output and the final reply arrive later as plain text messages
+        job = submit_command_job(ctx, spec.verb, lambda job_ctx: router.dispatch(cmd_str, job_ctx))
+        if job is None:
+            return ws_ack(msg_id, False, reply="ERROR:JOBS_BUSY")
+        return ws_ack(msg_id, True, job=job.id)
+    result = router.dispatch(cmd_str, ctx)
+    return ws_ack(msg_id, result.ok, reply=result.line())
+
+def ws_origin_allowed(headers):
+    # Browsers always send Origin: only the dashboard, served from this host, may connect.
+    # Native clients send none; any other page the operator opens would get the full command set.
+    origin = headers.get("origin")
+    if not origin:
+        return True
+    try:
+        host = urllib.parse.urlsplit(origin).hostname
+        return host is not None and host == urllib.parse.urlsplit("//" + headers.get("host", "")).hostname
+    except ValueError:
+        return False
+
+async def websocket_session(reader, writer, headers):
+    """RFC 6455 session on the event hub port: one persistent connection for driving."""
+    key = headers.get("sec-websocket-key")
+    if headers.get("upgrade", "").lower() != "websocket" or not key:
+        writer.write(WS_BAD_REQUEST)
+        writer.close()
+        return
+    if not ws_origin_allowed(headers):
+        log_msg(f"WebSocket from foreign origin {headers.get('origin')} refused", "control", WARNING)
+        writer.write(WS_FORBIDDEN)
+        writer.close()
+        return
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+    writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                  "Upgrade: websocket\r\n"
+                  "Connection: Upgrade\r\n"
+                  f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+    sock = writer.get_extra_info("socket")
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Acks are tiny, don't let Nagle hold them
+
+    loop = asyncio.get_running_loop()
+    peer = writer.get_extra_info("peername")
+    addr = peer[0] if isinstance(peer, tuple) else "local"
+    outbox = Outbox(loop, writer, f"WS {addr}", ws_text)
+    ctx = CommandContext("WS", addr, outbox.send)
+    log_msg(f"WebSocket client {addr} connected", "control")
+    try:
+        while True:
+            opcode, payload = await ws_read_message(reader)
+            if opcode == WS_CLOSE:
+                writer.write(ws_frame(WS_CLOSE, payload[:2]))
+                break
+            if opcode == WS_PING:
+                writer.write(ws_frame(WS_PONG, payload))
+            elif opcode == WS_TEXT:
+                try:
+                    reply = ws_handle_message(payload.decode("utf-8"), ctx)
+                except UnicodeDecodeError:
+                    reply = ws_ack(None, False, error="not utf-8")
+                outbox.send(reply)
+    except ValueError as e:
+        log_msg(f"WebSocket {addr} protocol error: {e}", "control", WARNING)
+        writer.write(ws_frame(WS_CLOSE, (1002).to_bytes(2, "big")))
+    except (asyncio.IncompleteReadError, ConnectionError, OSError):
+        pass
+    finally:
+        outbox.close()
+        log_msg(f"WebSocket client {addr} disconnected", "control")
+        # Losing the driver stops the robot; a dashboard tab that never drove leaves it alone
+        if ctx.driving:
+            scheduler.emergency_stop(f"WebSocket client {addr} disconnected")
+
+# --- Event Stream Hub ---
+SSE_PORT = 5001
+SSE_HEARTBEAT = 20 # Seconds without events before a heartbeat comment is sent
+SSE_MAX_BUFFER = 256 * 1024 # Subscribers with more unsent bytes than this are disconnected
+SSE_HEADERS = (b"HTTP/1.1 200 OK\r\n"
+               b"Content-Type: text/event-stream\r\n"
+               b"Cache-Control: no-cache\r\n"
+               b"Connection: keep-alive\r\n"
+               b"Access-Control-Allow-Origin: *\r\n\r\n"
+               b"retry: 3000\n\n")
+SSE_NOT_FOUND = b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+
+class EventSubscriber:
+    __slots__ = ("writer", "pending")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = [] # Live frames held back while the backlog is replayed, None once live
+
+class EventStreamHub:
+    """Serves /stream_logs and /stream_state to any number of viewers from the asyncio loop.
+
+    The same port also accepts WebSocket upgrades on /ws (see websocket_session).
+
+    A single pump thread reads the log ring and hands each batch to the loop,
+    where it is encoded once into one SSE event and written to every
+    subscriber. State changes are pushed the same way as deltas since the
+    last published version. Viewers cost a socket, not a thread.
+    Reconnecting browsers send Last-Event-ID and get what they missed first.
+    A subscriber that stops reading is dropped once its send buffer passes
+    SSE_MAX_BUFFER; the browser reconnects and resumes from its last id.
+    """
+
+    def __init__(self):
+        self.channels = {"logs": set(), "state": set()}
+        self.loop = None
+        self.cursor = 0 # Sequence number of the next line the pump will publish
+        self.state_version = 0 # Last state version pushed
+        self.last_write = 0.0
+        self.running = False
+
+    def _broadcast(self, channel, frame):
+        self.last_write = self.loop.time()
+        subscribers = self.channels[channel]
+        for sub in list(subscribers):
+            if sub.pending is not None:
+                sub.pending.append(frame)
+                continue
+            transport = sub.writer.transport
+            if transport.is_closing():
+                subscribers.discard(sub)
+            elif transport.get_write_buffer_size() > SSE_MAX_BUFFER:
+                subscribers.discard(sub)
+                sub.writer.close()
+            else:
+                sub.writer.write(frame)
+
+    def publish_logs(self, frame, cursor):
+        self.cursor = cursor
+        self._broadcast("logs", frame)
+
+    def publish_state(self):
+        # Runs on the loop; coalesces however many updates happened since the last push
+        delta = state.delta(self.state_version)
+        if delta["changes"]:
+            self.state_version = delta["version"]
+            self._broadcast("state", state_frame(delta).encode())
+
+    def _pump(self, listener):
+        reported = 0
+        while True:
+            first, entries = log_manager.read(listener, timeout=SSE_HEARTBEAT)
+            if entries:
+                frame = log_frame(first, entries, listener.dropped - reported).encode()
+                reported = listener.dropped
+                self.loop.call_soon_threadsafe(self.publish_logs, frame, first + len(entries))
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(SSE_HEARTBEAT)
+            if self.loop.time() - self.last_write >= SSE_HEARTBEAT:
+                for channel in self.channels:
+                    self._broadcast(channel, b": heartbeat\n\n")
+
+    async def _send_logs(self, sub, last_id, params):
+        upto = self.cursor
+        resume = int(last_id) + 1 if last_id.isdigit() else upto - log_manager.history
+        dropped, first, entries = await self.loop.run_in_executor(None, log_replay, max(0, resume), upto)
+        if entries or dropped:
+            sub.writer.write(log_frame(first, entries, dropped).encode())
+
+    async def _send_state(self, sub, last_id, params):
+        since = last_id or params.get("since", "")
+        delta = state.delta(int(since) if since.isdigit() else 0)
+        if delta["changes"]:
+            sub.writer.write(state_frame(delta).encode())
+
+    async def handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        parts = request_line.split()
+        path, _, query = parts[1].partition("?") if len(parts) > 1 else ("", "", "")
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        routes = {"/stream_logs": ("logs", self._send_logs), "/stream_state": ("state", self._send_state)}
+        if parts[:1] == ["GET"] and path == "/ws":
+            await websocket_session(reader, writer, headers)
+            return
+        if parts[:1] != ["GET"] or path not in routes:
+            writer.write(SSE_NOT_FOUND)
+            writer.close()
+            return
+        channel, send_backlog = routes[path]
+        params = dict(item.partition("=")[::2] for item in query.split("&") if item)
+
+        writer.write(SSE_HEADERS)
+        sub = EventSubscriber(writer)
+        self.channels[channel].add(sub)
+        try:
+            await send_backlog(sub, headers.get("last-event-id", ""), params)
+            writer.write(b"".join(sub.pending))
+            sub.pending = None
+            # Nothing is expected from the browser, reading only detects the disconnect
+            while await reader.read(1024):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.channels[channel].discard(sub)
+            writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            server = await asyncio.start_server(self.handle, host="0.0.0.0", port=SSE_PORT)
+        except OSError as e:
+            print(f"Event stream hub disabled, streams served by Flask: {e}")
+            return
+        listener = log_manager.add_listener(replay=0)
+        self.cursor = listener.cursor
+        self.state_version = state.version
+        threading.Thread(target=self._pump, args=(listener,), name="event-hub", daemon=True).start()
+        state.watch(lambda: self.loop.call_soon_threadsafe(self.publish_state))
+        heartbeat = asyncio.create_task(self._heartbeat())
+        self.running = True
+        print(f"Event stream hub on port {SSE_PORT}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.running = False
+            heartbeat.cancel()
+
+event_hub = EventStreamHub()
+
+async def serve_all(listen):
+    # Listeners may give up (no adapter, no permission), the hub keeps running
+    await asyncio.gather(event_hub.serve(), serve_transports(listen))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Motor control server")
+    parser.add_argument("--listen", action="append", metavar="SPEC",
+                        help='command listener, repeatable: "rfcomm[:channel]", "tcp:[host:]port" or "unix:/path" '
+                             '(default: "listen" from config.json, else rfcomm)')
+    args = parser.parse_args()
+    listen = args.listen or state.get("config").get("listen") or DEFAULT_LISTEN
+
     # Start Web Server in a background thread
     web_thread = threading.Thread(target=run_flask, daemon=True)
     web_thread.start()
     print("Web Interface started at http://<IP>:5000")
 
-    server_loop()
+    try:
+        asyncio.run(serve_all(listen))
+    except KeyboardInterrupt:
+        print("Stopping Server")